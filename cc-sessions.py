@@ -14,238 +14,279 @@
 #  [root@aio91-algarvin ~]# echo "delete http://cisco.com/controlCenterUsers:Users" | nc lbvip02 11211
 #  DELETED
 
-# TODO: replace the hacky deserializer with Google's java-to-python deserializer.
-# 	also, allow manipulation of logged in users
+# TODO: allow manipulation of logged in users
 
-import os, sys, argparse, json, socket, datetime
-from StringIO import StringIO
+import os, sys, argparse, json, socket, datetime, time, multiprocessing
+import javaser                  # javaser.py, next to this
 
+GET_KEYS = 100      # keys per memcached get command
+GET_PIPELINE = 4    # get commands sent ahead of reading their replies
+
+USERS_KEY = "http://cisco.com/controlCenterUsers:Users"
+SESSIONS_KEY = "http://cisco.com/controlCenterSessions:{0}"
+
+class MemcacheError(Exception):
+    pass
 
-class CcLoginInfo:
-    debug = False
 
+class Memcache:
+    # Just as much of the memcached text protocol as this needs, get. A reply
+    # is read by its framing, a "VALUE <key> <flags> <bytes>" line then
+    # exactly <bytes> of data, never by guessing from how much a recv()
+    # happened to return. Everything is read into the one buffer, kept (and
+    # grown if a value needs it) for every reply on the one connection.
+    def __init__(self, server, port, debug=False, size=65536):
+        self.debug = debug
+        self.conn = socket.create_connection((server, port))
+        self.buf = bytearray(size)
+        self.start = self.end = 0       # buf[start:end] is read but not used yet
 
-    # This is an awesome but completely hacky hack I got off:
-    # http://stackoverflow.com/questions/1714624/is-there-any-library-to-deserialize-with-python-which-is-serialized-with-java/16470856
-
-    def parse(self, f):
-        h = lambda s: ' '.join('%.2X' % ord(x) for x in s) # format as hex
-        p = lambda s: sum(ord(x)*256**i for i, x in enumerate(reversed(s))) # parse integer
-        magic = f.read(2)
-        assert magic == '\xAC\xED', h(magic) # STREAM_MAGIC
-        assert p(f.read(2)) == 5 # STREAM_VERSION
-        handles = []
-        def parse_obj():
-            b = f.read(1)
-            if not b:
-                raise StopIteration # not necessarily the best thing to throw here.
-            if b == '\x70': # p TC_NULL
-                return None
-            elif b == '\x71': # q TC_REFERENCE
-                handle = p(f.read(4)) - 0x7E0000 # baseWireHandle
-                o = handles[handle]
-                return o[1]
-            elif b == '\x74': # t TC_STRING
-                string = f.read(p(f.read(2))).decode('utf-8')
-                handles.append(('TC_STRING', string))
-                return string
-            elif b == '\x75': # u TC_ARRAY
-                data = []
-                cls = parse_obj()
-                size = p(f.read(4))
-                handles.append(('TC_ARRAY', data))
-                assert cls['_name'] in ('[B', '[I'), cls['_name']
-                for x in range(size):
-                    data.append(f.read({'[B': 1, '[I': 4}[cls['_name']]))
-                return data
-            elif b == '\x7E': # ~ TC_ENUM
-                enum = {}
-                enum['_cls'] = parse_obj()
-                handles.append(('TC_ENUM', enum))
-                enum['_name'] = parse_obj()
-                return enum
-            elif b == '\x72': # r TC_CLASSDESC
-                cls = {'fields': []}
-                full_name = f.read(p(f.read(2)))
-                cls['_name'] = full_name.split('.')[-1] # i don't care about full path
-                f.read(8) # uid
-                cls['flags'] = f.read(1)
-                handles.append(('TC_CLASSDESC', cls))
-                assert cls['flags'] in ('\2', '\3', '\x0C', '\x12'), h(cls['flags'])
-                b = f.read(2)
-                for i in range(p(b)):
-                    typ = f.read(1)
-                    name = f.read(p(f.read(2)))
-                    fcls = parse_obj() if typ in 'L[' else ''
-                    cls['fields'].append((name, typ, fcls.split('/')[-1])) # don't care about full path
-                b = f.read(1)
-                assert b == '\x78', h(b)
-                cls['parent'] = parse_obj()
-                return cls
-            # TC_OBJECT
-            assert b == '\x73', (h(b), h(f.read(4)), repr(f.read(50)))
-            obj = {}
-            obj['_cls'] = parse_obj()
-            obj['_name'] = obj['_cls']['_name']
-            handle = len(handles)
-            parents = [obj['_cls']]
-            while parents[0]['parent']:
-                parents.insert(0, parents[0]['parent'])
-            handles.append(('TC_OBJECT', obj))
-            for cls in parents:
-                for name, typ, fcls in cls['fields'] if cls['flags'] in ('\2', '\3') else []:
-                    if typ == 'I': # Integer
-                        obj[name] = p(f.read(4))
-                    elif typ == 'S': # Short
-                        obj[name] = p(f.read(2))
-                    elif typ == 'J': # Long
-                        obj[name] = p(f.read(8))
-                    elif typ == 'Z': # Bool
-                        b = f.read(1)
-                        assert p(b) in (0, 1)
-                        obj[name] = bool(p(b))
-                    elif typ == 'F': # Float
-                        obj[name] = h(f.read(4))
-                    elif typ in 'BC': # Byte, Char
-                        obj[name] = f.read(1)
-                    elif typ in 'L[': # Object, Array
-                        obj[name] = parse_obj()
-                    else: # Unknown
-                        assert False, (name, typ, fcls)
-                if cls['flags'] in ('\3', '\x0C'): # SC_WRITE_METHOD, SC_BLOCKDATA
-                    b = f.read(1)
-                    if b == '\x77': # see the readObject / writeObject methods
-                        block = f.read(p(f.read(1)))
-                        if cls['_name'].endswith('HashMap') or cls['_name'].endswith('Hashtable'):
-                            # http://javasourcecode.org/html/open-source/jdk/jdk-6u23/java/util/HashMap.java.html
-                            # http://javasourcecode.org/html/open-source/jdk/jdk-6u23/java/util/Hashtable.java.html
-                            assert len(block) == 8, h(block)
-                            size = p(block[4:])
-                            obj['data'] = [] # python doesn't allow dicts as keys
-                            for i in range(size):
-                                k = parse_obj()
-                                v = parse_obj()
-                                obj['data'].append((k, v))
-                            try:
-                                obj['data'] = dict(obj['data'])
-                            except TypeError:
-                                pass # non hashable keys
-                        elif cls['_name'].endswith('HashSet'):
-                            # http://javasourcecode.org/html/open-source/jdk/jdk-6u23/java/util/HashSet.java.html
-                            assert len(block) == 12, h(block)
-                            size = p(block[-4:])
-                            obj['data'] = []
-                            for i in range(size):
-                                obj['data'].append(parse_obj())
-                        elif cls['_name'].endswith('ArrayList'):
-                            # http://javasourcecode.org/html/open-source/jdk/jdk-6u23/java/util/ArrayList.java.html
-                            assert len(block) == 4, h(block)
-                            obj['data'] = []
-                            for i in range(obj['size']):
-                                obj['data'].append(parse_obj())
-                        else:
-                            assert False, cls['_name']
-                        b = f.read(1)
-                    assert b == '\x78', h(b) + ' ' + repr(f.read(30)) # TC_ENDBLOCKDATA
-            handles[handle] = ('py', obj)
-            return obj
-        objs = []
-        while 1:
-            try:
-                objs.append(parse_obj())
-            except StopIteration:
-                return objs
-
-    def memcache_command(self, cmd):
-        if not "\n" in cmd:
-            cmd += "\r\n"
+    def fill(self, need):
+        # read until buf[start:] holds at least need bytes
+        if self.start + need > len(self.buf):
+            pending = self.end - self.start
+            if need > len(self.buf):
+                self.buf.extend(bytearray(max(need, 2 * len(self.buf)) - len(self.buf)))
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start, self.end = 0, pending
+        view = memoryview(self.buf)
+        while self.end - self.start < need:
+            n = self.conn.recv_into(view[self.end:])
+            if not n:
+                raise MemcacheError("connection closed by server")
+            self.end += n
+
+    def readline(self):
+        while True:
+            i = self.buf.find(b"\r\n", self.start, self.end)
+            if i >= 0:
+                line = bytes(self.buf[self.start:i])
+                self.start = i + 2
+                return line
+            self.fill(self.end - self.start + 1)
+
+    def read(self, size):
+        self.fill(size + 2)
+        end = self.start + size
+        if self.buf[end:end + 2] != b"\r\n":
+            raise MemcacheError("value not terminated by CRLF")
+        data = bytes(self.buf[self.start:end])
+        self.start = end + 2
+        return data
+
+    def send_get(self, keys):
+        cmd = "get {0}".format(" ".join(keys))
         if self.debug:
-            print("DEBUG: Sending memcache command: {0}".format(cmd.strip()))
-        self.conn.send(cmd)
+            print("DEBUG: Sending memcache command: {0}".format(cmd))
+        self.conn.sendall(cmd + "\r\n")
+
+    def get(self, *keys):
+        # {key: (flags, data)} for each of keys memcached has
+        self.send_get(keys)
+        return self.read_values()
 
-        memcache_return = output = self.conn.recv(4096)
-        while len(output) == 4096:
-            memcache_return += output
-            output = self.conn.recv(4096)
+    def get_multi(self, keys, chunk=GET_KEYS, window=GET_PIPELINE):
+        # get() for any number of keys: chunk keys to a command, with up to
+        # window commands sent before the first reply is read, so the round
+        # trips overlap. Few enough that they fit the socket buffers, or the
+        # server could stop reading us while we wait to send it more.
+        chunks = [keys[i:i + chunk] for i in range(0, len(keys), chunk)]
+        values = {}
+        sent = 0
+        for done in range(len(chunks)):
+            while sent < len(chunks) and sent - done < window:
+                self.send_get(chunks[sent])
+                sent += 1
+            values.update(self.read_values())
+        return values
+
+    def read_values(self):
+        # the VALUE blocks up to END of a get reply
+        values = {}
+        while True:
+            line = self.readline()
+            if self.debug:
+                print("DEBUG: Return value from memcache: {0}".format(repr(line)))
+            if line == b"END":
+                return values
+            parts = line.split()
+            if len(parts) < 4 or parts[0] != b"VALUE":
+                raise MemcacheError(line)       # ERROR, SERVER_ERROR ...
+            values[parts[1]] = (int(parts[2]), self.read(int(parts[3])))
+
+
+class SessionError(Exception):
+    pass
+
+
+class SessionReader:
+    # The Control Center users and their sessions held by one memcached
+    def __init__(self, server, port, debug=False):
+        self.debug = debug
         if self.debug:
-            print("DEBUG: Return value from memcache: {0}".format(repr(output)))
-        return memcache_return
-            
+            print("DEBUG: Opening socket to {0}:{1}".format(server, port))
+        self.memcache = Memcache(server, port, debug)
+        self.memcache_secs = 0.0        # waiting on memcached, the rest is decoding
+
+    def decode(self, value):
+        # the Java objects in a (flags, data) from Memcache, None for no value
+        if value is None:
+            return None
+        flags, bin_data = value
+
+        if self.debug:
+            print("DEBUG: Metadata: flags {0}, {1} bytes".format(flags, len(bin_data)))
+            print("DEBUG: Parsing Java serialized data: {0}".format(repr(bin_data)))
+        try:
+            objs = javaser.loads(bin_data)
+        except javaser.JavaSerError as e:
+            if self.debug:
+                print("DEBUG: {0}".format(e))
+            raise SessionError("ERROR: unable to parse serialized data. Try with -v option to see problem")
+
+        if self.debug:
+            print("DEBUG: Json return value: {0}".format(repr(objs)))
+        if not isinstance(objs, list) or not "data" in objs[0]:
+            raise SessionError("ERROR: Malformed return JSON. Try with -v to see return value")
+        return objs
+
+    def sessions(self):
+        # (users logged on, [(user, remote IP, session ID, start time in ms), ...]),
+        # users is None if there's no users list at all
+        t0 = time.time()
+        values = self.memcache.get(USERS_KEY)
+        self.memcache_secs += time.time() - t0
+        users = self.decode(values.get(USERS_KEY))
+        if users is None:
+            return None, []
+        users = users[0]["data"]
+
+        # every user's sessions in as few round trips as possible
+        keys = dict((u, SESSIONS_KEY.format(u)) for u in users)
+        if self.debug:
+            print("DEBUG: querying memcache about users {0}".format(", ".join(keys)))
+        t0 = time.time()
+        values = self.memcache.get_multi(list(keys.values()))
+        self.memcache_secs += time.time() - t0
+
+        rows = []
+        for u in users:
+            session = self.decode(values.get(keys[u]))
+            if session is None:
+                continue
+            for sess in session[0]["data"]:
+                sess_data = sess["data"]
+                rows.append((u, sess_data["RemoteIpAddress"], sess_data["SessionId"], sess_data["StartTime"]["value"]))
+        return users, rows
+
+
+def split_endpoint(endpoint):
+    # host:port, [v6 address]:port or just host, for the default port
+    host, port = endpoint, 11211
+    if endpoint.startswith("["):
+        host, rest = endpoint[1:].split("]", 1)
+        if rest:
+            port = rest.lstrip(":")
+    elif endpoint.count(":") == 1:
+        host, port = endpoint.split(":")
+    return host, int(port)
+
+
+def scan_endpoint(job):
+    # --endpoints: one endpoint's users and sessions, run in a worker process
+    # (endpoint, users, rows, (connect, memcache, decode secs), error)
+    endpoint, debug = job
+    t0 = time.time()
+    try:
+        reader = SessionReader(*split_endpoint(endpoint), debug=debug)
+        connect = time.time() - t0
+        users, rows = reader.sessions()
+    except (SessionError, MemcacheError, socket.error, ValueError) as e:
+        return endpoint, None, [], None, str(e) or e.__class__.__name__
+    total = time.time() - t0
+    return endpoint, users, rows, (connect, reader.memcache_secs, total - connect - reader.memcache_secs), None
+
+
+class CcLoginInfo:
+    debug = False
 
     def __init__(self):
         parser = argparse.ArgumentParser(description="Script to list control center user info")
         parser.add_argument("-s", "--server", default="lbvip02", help="Server to connect to (default: lbvip02")
         parser.add_argument("-p", "--port", default=11211, type=int, help="Port to connect to (default: 11211")
+        parser.add_argument("-e", "--endpoints", nargs="+", metavar="HOST:PORT", help="Check all these memcached instead, at once, and list every session found once, with where it was found")
+        parser.add_argument("-j", "--jobs", type=int, default=0, help="with -e, endpoints to check at once (default: all of them)")
         parser.add_argument("-v", "--verbose", action="store_true", help="Verbose debugging output")
         args = parser.parse_args()
         if args.verbose:
             self.debug = True
 
-        if self.debug:
-            print("DEBUG: Opening socket to {0}:{1}".format(args.server, args.port))
+        if args.endpoints:
+            sys.exit(self.scan(args))
+
         try:
-            self.conn = socket.create_connection((args.server, args.port))
+            reader = SessionReader(args.server, args.port, self.debug)
         except:
             print("Unable to connect to {0}:{1}".format(args.server, args.port))
             sys.exit(1)
 
-        output = self.memcache_command("get http://cisco.com/controlCenterUsers:Users")
-        
-
-        if not "controlCenterUsers" in output:
-            print("No control center users found")
-            sys.exit(0)
-
-        bin_data_start = output.index("\r\n") + 2
-        bin_data_end = output.index("\r\nEND")
-        bin_data = output[bin_data_start:bin_data_end]
-        meta_data = output[:bin_data_start - 2]
-
-        if self.debug:
-            print("DEBUG: Metadata: {0}".format(meta_data))
-            print("DEBUG: Parsing Java serialized data: {0}".format(repr(bin_data)))
-        
         try:
-            users = self.parse(StringIO(bin_data))
-        except:
-            print("ERROR: unable to parse serialized data. Try with -v option to see problem")
+            users, rows = reader.sessions()
+        except (MemcacheError, socket.error) as e:
+            print("ERROR: memcache: {0}".format(e))
             sys.exit(1)
-
-        if self.debug:
-            print("DEBUG: Json return value: {0}".format(repr(users)))
-        if not isinstance(users, list) or not "data" in users[0]:
-            print("ERROR: Malformed return JSON. Try with -v to see return value")
+        except SessionError as e:
+            print(e)
             sys.exit(1)
-        print("Found the following users logged on: {0}".format(", ".join(users[0]["data"])))
+        self.list_sessions(users, rows)
+
+    def list_sessions(self, users, rows):
+        if users is None:
+            print("No control center users found")
+            sys.exit(0)
+        print("Found the following users logged on: {0}".format(", ".join(users)))
         
         
         print("\n{0:12}   {1:16}  {2:30} {3}".format("User", "Remote IP", "Session ID", "Session Start Time"))
         print("{0:12}   {1:16}  {2:30} {3}".format("----", "------ --", "------- --", "------- ----- ----"))
-        for u in users[0]["data"]:
-            if self.debug:
-                print("DEBUG: querying memcache about user '{0}'".format(u))
-            out = self.memcache_command("get http://cisco.com/controlCenterSessions:{0}".format(u))
-            bin_data_start = out.index("\r\n") + 2
-            bin_data_end = out.index("\r\nEND")
-            bin_data = out[bin_data_start:bin_data_end]
-            meta_data = out[:bin_data_start - 2]
+        for u, remote_ip, session_id, start in rows:
+            print("{0:12}   {1:16}  {2:30} {3}".format(u, remote_ip, session_id, datetime.datetime.fromtimestamp(start/1000).ctime()))
 
-            if self.debug:
-                print("DEBUG: Metadata: {0}".format(meta_data))
-                print("DEBUG: Parsing Java serialized data: {0}".format(repr(bin_data)))
-            try:
-                session = self.parse(StringIO(bin_data))
-            except:
-                print("ERROR: unable to parse serialized data. Try with -v option to see problem")
-                sys.exit(1)
-            if self.debug:
-                print("DEBUG: Json return value: {0}".format(repr(session)))
-            if not isinstance(session, list) or not "data" in session[0]:
-                print("ERROR: Malformed return JSON. Try with -v to see return value")
-                sys.exit(1)
-            for sess in session[0]["data"]:
-                sess_data = sess["data"]
-                print("{0:12}   {1:16}  {2:30} {3}".format(u, sess_data["RemoteIpAddress"], sess_data["SessionId"], datetime.datetime.fromtimestamp(sess_data["StartTime"]["value"]/1000).ctime()))
+    def scan(self, args):
+        # -e: every endpoint fetched and decoded in a process of its own, the
+        # sessions merged (the same session can be in several of them), then
+        # how long each endpoint took
+        jobs = min(args.jobs or len(args.endpoints), len(args.endpoints))
+        pool = multiprocessing.Pool(jobs)
+        results = pool.map(scan_endpoint, [(e, self.debug) for e in args.endpoints], 1)
+        pool.close()
+
+        users, sessions = set(), {}
+        for endpoint, found, rows, times, error in results:
+            users.update(found or [])
+            for u, remote_ip, session_id, start in rows:
+                sessions.setdefault((u, session_id), [u, remote_ip, session_id, start, []])[4].append(endpoint)
+
+        if users:
+            print("Found the following users logged on: {0}".format(", ".join(sorted(users))))
+        else:
+            print("No control center users found")
+        print("\n{0:12}   {1:16}  {2:30} {3:24}  {4}".format("User", "Remote IP", "Session ID", "Session Start Time", "Found on"))
+        print("{0:12}   {1:16}  {2:30} {3:24}  {4}".format("----", "------ --", "------- --", "------- ----- ----", "----- --"))
+        for u, remote_ip, session_id, start, endpoints in sorted(sessions.values(), key=lambda s: (s[0], s[3])):
+            print("{0:12}   {1:16}  {2:30} {3:24}  {4}".format(u, remote_ip, session_id,
+                datetime.datetime.fromtimestamp(start/1000).ctime(), ", ".join(endpoints)))
+
+        failed = 0
+        print("\n{0:24} {1:>6} {2:>9} {3:>11} {4:>12} {5:>10}".format("Endpoint", "Users", "Sessions", "Connect ms", "Memcache ms", "Decode ms"))
+        for endpoint, found, rows, times, error in results:
+            if error:
+                failed += 1
+                print("{0:24} ERROR: {1}".format(endpoint, error))
+                continue
+            print("{0:24} {1:6} {2:9} {3:11.1f} {4:12.1f} {5:10.1f}".format(endpoint, len(found or []), len(rows),
+                *[t * 1000 for t in times]))
+        return 1 if failed else 0
 
 
 if __name__ == "__main__":
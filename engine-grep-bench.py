@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# Benchmark for engine-grep.py. Builds a synthetic consolidated-engine.log
+# and times engine-grep.py against it: the common modes (one pattern, -a, -v,
+# -i) in MB/s, then -F with growing pattern lists, then an -x index lookup
+# against a scan for the same keys as whole values (their output has to
+# match). --profile runs each mode under cProfile as well. Works with python2
+# and python3.
+
+# Not official Cisco software.
+
+import argparse
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# (name, engine-grep.py arguments); the patterns fit the records make_log()
+# writes, matching a small fraction of them (all but a fraction for -v)
+MODES = [
+    ("single", ["-e", "Framed-IP-Address: 10.1.2."]),
+    ("and", ["-a", "-e", "msisdn=15551", "-e", "Framed-IP-Address: 10.1."]),
+    ("invert", ["-v", "-e", "avp 39 "]),
+    ("icase", ["-i", "-e", "framed-ip-address: 10.1.2."]),
+]
+
+def make_log(fn, size_mb, seed=1):
+    # Records look enough like the real thing for the splitter and the
+    # patterns: a "qnsNN [timestamp] =====" header, some diameter AVPs with
+    # an IMSI/MSISDN/framed IP, filler, then a ===== line.
+    rnd = random.Random(seed)
+    target = size_mb * 1024 * 1024
+    written, n = 0, 0
+    fd = open(fn, "w")
+    while written < target:
+        secs = n // 20
+        rec = ["qns%02d [2016-06-01 %02d:%02d:%02d,%03d] %s" % (n % 8 + 1,
+            secs // 3600 % 24, secs // 60 % 60, secs % 60, n % 1000, "=" * 60)]
+        rec.append("INFO: Start Policy Request Processing")
+        rec.append("  Session-Id: gx.lb01;%d;%d" % (n, rnd.randint(0, 99999999)))
+        rec.append("  Subscription-Id-Data: 31026%010d" % rnd.randint(0, 9999999))
+        rec.append("  msisdn=1555%07d" % rnd.randint(0, 9999999))
+        rec.append("  Framed-IP-Address: 10.%d.%d.%d" % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)))
+        for i in range(rnd.randint(5, 40)):
+            rec.append("    DEBUG c.b.p.e.d.Handler - avp %d value=%08x" % (i, rnd.randint(0, 0xffffffff)))
+        rec.append("=" * 60)
+        s = "\n".join(rec) + "\n"
+        fd.write(s)
+        written += len(s)
+        n += 1
+    fd.close()
+    return n
+
+def make_patterns(fn, count, seed=2):
+    rnd = random.Random(seed)
+    fd = open(fn, "w")
+    for i in range(count):
+        fd.write("31026%010d\n" % rnd.randint(0, 9999999))
+    fd.close()
+
+def index_keys(fn, count):
+    # Framed IPs from the log, each with the one it starts with (10.1.2.123
+    # and 10.1.2.12), so the lookup also sees keys that prefix other keys
+    keys = []
+    fd = open(fn)
+    for line in fd:
+        if line.startswith("  Framed-IP-Address: "):
+            ip = line.split()[1]
+            keys.append(ip)
+            if not ip[:-1].endswith("."):
+                keys.append(ip[:-1])
+            if len(keys) >= count:
+                break
+    fd.close()
+    return keys
+
+def output_of(cmd, fn, extra):
+    t0 = time.time()
+    p = subprocess.Popen(cmd + extra + [fn], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out = p.communicate()[0]
+    return time.time() - t0, out
+
+def run(cmd, fn, extra):
+    t0 = time.time()
+    devnull = open(os.devnull, "w")
+    rc = subprocess.call(cmd + extra + [fn], stdout=devnull)
+    devnull.close()
+    return time.time() - t0, rc
+
+def best_of(args, cmd, fn, extra):
+    best = None
+    for i in range(args.repeat):
+        secs, rc = run(cmd, fn, extra)
+        best = secs if best is None or secs < best else best
+    return best
+
+def profile(args, tmpdir, fn, name, extra):
+    # cProfile of one run, the top functions by own time
+    stats = os.path.join(tmpdir, "profile-%s" % name)
+    python = args.python or sys.executable
+    devnull = open(os.devnull, "w")
+    subprocess.call([python, "-m", "cProfile", "-o", stats, args.script] + extra + [fn],
+        stdout=devnull)
+    devnull.close()
+    print("\n--- %s: %s" % (name, " ".join(extra)))
+    subprocess.call([python, "-c", "import pstats; pstats.Stats(%r).sort_stats('tottime').print_stats(%d)"
+        % (stats, args.top)])
+
+def main(args):
+    tmpdir = tempfile.mkdtemp(prefix="engine-grep-bench.")
+    log = args.log
+    if not log:
+        log = os.path.join(tmpdir, "consolidated-engine.log")
+        print("Generating %d MB synthetic log in %s" % (args.size, log))
+        records = make_log(log, args.size)
+        print("  %d records" % records)
+    size_mb = os.path.getsize(log) / float(1024 ** 2)
+    size_gb = size_mb / 1024
+
+    cmd = [args.script]
+    if args.python:
+        cmd = [args.python, args.script]
+
+    modes = [m for m in MODES if m[0] in args.modes]
+    print("\n%8s  %10s  %10s" % ("mode", "seconds", "MB/s"))
+    for name, extra in modes:
+        best = best_of(args, cmd, log, extra)
+        print("%8s  %10.2f  %10.1f" % (name, best, size_mb / best))
+
+    print("\n%8s  %10s  %10s" % ("patterns", "seconds", "sec/GB"))
+    for count in args.counts:
+        patfile = os.path.join(tmpdir, "patterns-%d" % count)
+        make_patterns(patfile, count)
+        best = best_of(args, cmd, log, ["-F", patfile])
+        print("%8d  %10.2f  %10.1f" % (count, best, best / size_gb))
+
+    failed = False
+    if args.keys:
+        # built first, so the lookup below only brings it up to date
+        devnull = open(os.devnull, "w")
+        subprocess.call(cmd + ["--build-index", log], stdout=devnull)
+        devnull.close()
+        # -x only finds a key as a whole field, where the plain patterns would
+        # also match 10.1.2.12 inside 10.1.2.123 (and . anything), so the scan
+        # it's held against looks for each one as the whole framed IP
+        extra, scan = [], []
+        for key in index_keys(log, args.keys):
+            extra += ["-e", key]
+            scan += ["-e", "Framed-IP-Address: %s$" % re.escape(key)]
+        scan_secs, scan_out = output_of(cmd, log, scan)
+        index_secs, index_out = output_of(cmd, log, ["-x"] + extra)
+        failed = scan_out != index_out
+        print("\n%8s  %10s  %10s  %s" % ("keys", "scan", "index", "output"))
+        print("%8d  %10.2f  %10.2f  %s" % (len(extra) // 2, scan_secs, index_secs,
+            "DIFFERS" if failed else "same"))
+
+    if args.profile:
+        for name, extra in modes:
+            profile(args, tmpdir, log, name, extra)
+
+    shutil.rmtree(tmpdir)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="benchmark engine-grep.py")
+    ap.add_argument("-s", "--size", type=int, default=256, help="synthetic log size in MB (default: 256)")
+    ap.add_argument("-l", "--log", help="use this log instead of generating one")
+    ap.add_argument("-m", "--modes", nargs="+", default=[m[0] for m in MODES],
+        choices=[m[0] for m in MODES], help="modes to time (default: all)")
+    ap.add_argument("-n", "--counts", type=int, nargs="*", default=[1, 10, 100, 1000, 10000],
+        help="pattern counts to time with -F (default: 1 10 100 1000 10000)")
+    ap.add_argument("-x", "--keys", type=int, default=100,
+        help="framed IPs to look up with -x and compare with a scan, 0 to skip (default: 100)")
+    ap.add_argument("-r", "--repeat", type=int, default=3, help="runs per measurement, best is kept (default: 3)")
+    ap.add_argument("-p", "--python", help="interpreter to run engine-grep.py with (default: its #! line)")
+    ap.add_argument("--script", default=os.path.join(HERE, "engine-grep.py"), help="engine-grep.py to time")
+    ap.add_argument("--profile", action="store_true", help="also run each mode under cProfile")
+    ap.add_argument("--top", type=int, default=15, help="functions to show per profile (default: 15)")
+    args = ap.parse_args()
+    main(args)
@@ -1,103 +1,1022 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 # This is for pulling complete records from the consolidated-engine.log based on patterns.
 # This is also the first non-trivial python program I ever wrote, in 2015. It's very unpythonic.
 # Someday I'll recode it.
+# Runs on python3, and still on python2 for the older lb VMs. Records are
+# matched as bytes and never decoded, except for -J.
 
-import os, sys, errno, re, getopt, time, signal
+import os, sys, errno, re, getopt, time, signal, multiprocessing, json, atexit
+import gzip, subprocess, threading, mmap, zlib, select, struct, ctypes, ctypes.util
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# inotify through libc for -f, when it's there. Otherwise we poll with stat().
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    libc.inotify_init1
+except (OSError, AttributeError):
+    libc = None
+
+# patterns and file names as given <-> bytes, undecodable bytes surviving
+# the round trip
+if sys.version_info[0] >= 3:
+    to_bytes, to_str = os.fsencode, os.fsdecode
+else:
+    to_bytes = to_str = lambda s: s
 
 final_return = False
-grep_patterns = []
-doc_start_re = re.compile("^[^ ]+ +\[[^]]+\] =+$")
-doc_end_re = re.compile("^=+$")
+grep_patterns = None
+field_re = None
+output = None
+progress = None
+doc_start_re = re.compile(b"^[^ ]+ +\\[[^]]+\\] =+$")
+header_re = re.compile(b"^([^ ]+) +\\[([^]]+)\\]")
+header_time_re = re.compile(b"(\\d{4}-\\d{2}-\\d{2})[ T](\\d{2}:\\d{2}:\\d{2}(?:[.,]\\d+)?)")
+when_re = re.compile(r"^\d{4}-\d{2}-\d{2}([T ]\d{2}(:\d{2}(:\d{2})?)?)?$")
+# spelled out rather than re.IGNORECASE, which makes this several times slower
+index_key_re = re.compile(b"(?:Session-Id|diameterSessionKey|Framed-IP-Address|framedIp|"
+    b"Subscription-Id-Data|msisdn|MSISDN|Msisdn|imsi|IMSI|Imsi)\\s*[:=]\\s*([^\\s,\"'\\[\\]{}]+)")
+CHUNK_SIZE = 4 * 1024 * 1024
+RANGE_SIZE = 64 * 1024 * 1024
+MAX_DOC_LINES = 3000
+BISECT_MIN = 256 * 1024
+OUTPUT_BUFFER = 1024 * 1024
+WRITE_QUEUE = 32
+PROGRESS_INTERVAL = 5
+INDEX_HEADER = "#engine-index 1 %20d %20d %6d %08x %20d\n"
+INDEX_HEAD_BYTES = 4096
+IN_MODIFY, IN_MOVED_TO, IN_CREATE, IN_Q_OVERFLOW = 0x2, 0x80, 0x100, 0x4000
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
 
 def sig_handler(signal, frame):
     sys.exit(0)
 
-def grep_doc(opts, doc):
-    re_matches = dict(zip(grep_patterns, [False] * len(grep_patterns)))
-    re_match = False
+regex_meta_re = re.compile(r"[.^$*+?{}\[\]\\|()]")
+key_meta_re = re.compile(r"[\^$*+?{}\[\]\\|()]")
+backref_re = re.compile(r"\\[1-9]|\(\?P=")
+# things that can match a newline, so a pattern using them could match across
+# two lines of a record where it wouldn't have matched either line alone
+cross_line_re = re.compile(r"\\[sDWn]|\[\^|\(\?[aiLmux]*s")
 
-    for line in doc:
-        if re_match == True and not opts["opt_and"]:
-            break
-        for pat in grep_patterns:
-            if pat.search(line):
-                re_match = True
-                re_matches[pat] = True
-                if not opts["opt_and"]:
-                    break
+def line_pattern(p):
+    # Records are searched whole with re.MULTILINE, where $ only matches before
+    # a \n. On CRLF logs it has to match before the \r as well, the way it did
+    # when lines were matched one at a time with their \r\n stripped. \A and
+    # \Z meant the start and end of the line then, which is ^ and $ now.
+    out, i, in_class = [], 0, False
+    while i < len(p):
+        c = p[i]
+        if c == "\\":
+            c = p[i:i + 2]
+            if not in_class and c in ("\\A", "\\Z"):
+                out.append("^" if c == "\\A" else r"(?=\r?$)")
+                i += 2
+                continue
+        elif c == "[" and not in_class:
+            in_class = True
+            j = i + 1
+            if p[j:j + 1] == "^":
+                j += 1
+            if p[j:j + 1] == "]":
+                j += 1
+            c = p[i:j]
+        elif c == "]" and in_class:
+            in_class = False
+        elif c == "$" and not in_class:
+            out.append(r"(?=\r?$)")
+            i += 1
+            continue
+        out.append(c)
+        i += len(c)
+    return "".join(out)
+
+def trie_regex(words, whole=False):
+    # Folds a set of literal strings into one regex shaped like a trie, eg.
+    # ["31001", "31002", "3102"] -> "3(?:10(?:0(?:1|2)|2))", so the re engine
+    # walks each position once no matter how many IMSIs/MSISDNs were loaded.
+    # With whole, words that others start with are kept (as an empty
+    # alternative, tried last) for when the match is anchored at both ends.
+    trie = {}
+    for w in words:
+        node = trie
+        for c in w:
+            node = node.setdefault(c, {})
+        node[""] = True
+
+    def emit(node):
+        out = ""
+        # collapse single-child chains so recursion only happens at branches
+        while "" not in node and len(node) == 1:
+            c = list(node)[0]
+            out += re.escape(c)
+            node = node[c]
+        if "" in node and not whole:
+            # a shorter word ends here, which is all a match needs
+            return out
+        alts = [re.escape(c) + emit(node[c]) for c in sorted(node) if c]
+        if not alts:
+            return out
+        if "" in node:
+            alts.append("")
+        return out + "(?:" + "|".join(alts) + ")"
+
+    return emit(trie)
+
+class PatternSet:
+    # All the -e/-F patterns compiled into a single regex, so each record is
+    # scanned once regardless of how many patterns were given. Literal patterns
+    # go into a trie; real regexps are joined as an alternation of named groups
+    # (p0, p1, ...) which is what the --and bookkeeping uses to tell them apart.
+    # Anything that can't be combined (backreferences, inline flags, the python
+    # 2 named group limit) stays a separate compiled pattern.
+    # Patterns match within a line, as they always have. Records are searched
+    # without their last line end, so ^$ doesn't match after it. If a pattern
+    # could also match across lines (\s, [^...], ...) or can match nothing at
+    # all (^$, ^ *$), a record it hits is checked again a line at a time before
+    # it counts.
+    def __init__(self, patterns, flags):
+        # the patterns are looked at as str and compiled as bytes
+        given = [to_str(p) for p in patterns]
+        patterns = [line_pattern(p) for p in given]
+        self.patterns = []
+        for p, orig in zip(patterns, given):
+            try:
+                self.patterns.append(re.compile(to_bytes(p), flags))
+            except:
+                print("%s: invalid regexp" % orig)
+                sys.exit(1)
+        self.per_line = bool([p for p, regex in zip(patterns, self.patterns)
+            if cross_line_re.search(p) or regex.search(b"")])
+
+        separate, literals, regexps = [], [], []
+        for p, regex in zip(patterns, self.patterns):
+            if regex.flags != re.compile(b"", flags).flags or backref_re.search(p):
+                separate.append(regex)
+            elif not regex_meta_re.search(p):
+                literals.append(p.lower() if flags & re.IGNORECASE else p)
+            else:
+                regexps.append(p)
+
+        alts = ["(?:%s)" % p for p in regexps]
+        if literals:
+            alts.append(trie_regex(literals))
+        self.any_res = separate
+        if alts:
+            try:
+                self.any_res = [re.compile(to_bytes("|".join(alts)), flags)] + separate
+            except:
+                self.any_res = self.patterns
+
+        # plain strings can be looked up as keys in the index (-x). A "." is
+        # allowed since IPs and session ids are full of them; the records found
+        # are matched against the real regexps afterwards anyway.
+        self.keys = None
+        if not separate and not [p for p in patterns if key_meta_re.search(p)]:
+            self.keys = [to_bytes(p.lower() if flags & re.IGNORECASE else p) for p in patterns]
+
+        self.all_re = None
+        if not separate:
+            try:
+                self.all_re = re.compile(to_bytes("|".join("(?P<p%d>%s)" % (n, p)
+                    for n, p in enumerate(patterns))), flags)
+            except:
+                pass
+
+    def search_lines(self, doc, want):
+        # want (any or all) of the patterns matching some line of doc
+        lines = doc.split(b"\n")
+        if lines and not lines[-1]:
+            lines.pop()
+        lines = [line.rstrip(b"\r") for line in lines]
+        return want(any(regex.search(line) for line in lines) for regex in self.patterns)
+
+    def end(self, doc):
+        # where the record's text stops, before its last \n or \r\n
+        if doc.endswith(b"\r\n"):
+            return len(doc) - 2
+        if doc.endswith(b"\n"):
+            return len(doc) - 1
+        return len(doc)
+
+    def search_any(self, doc):
+        end = self.end(doc)
+        for regex in self.any_res:
+            if regex.search(doc, 0, end):
+                return not self.per_line or self.search_lines(doc, any)
+        return False
+
+    def search_all(self, doc):
+        if self.per_line:
+            return self.search_any(doc) and self.search_lines(doc, all)
+        end = self.end(doc)
+        if self.all_re is None:
+            for regex in self.patterns:
+                if not regex.search(doc, 0, end):
+                    return False
+            return True
+
+        missing = set(range(len(self.patterns)))
+        m = self.all_re.search(doc, 0, end)
+        while m:
+            start = m.start()
+            missing.discard(int(m.lastgroup[1:]))
+            # other patterns may match at this same spot but be shadowed by
+            # the alternative that won, so ask them directly
+            for n in list(missing):
+                if self.patterns[n].match(doc, start, end):
+                    missing.discard(n)
+            if not missing:
+                return True
+            m = self.all_re.search(doc, start + 1, end)
+        return False
+
+def match_doc(opts, doc):
+    # doc is a complete record (header line through closing ===== line) as one
+    # string, so each record is scanned once whatever the pattern count.
+    if opts["opt_and"]:
+        re_match = grep_patterns.search_all(doc)
+    else:
+        re_match = grep_patterns.search_any(doc)
     if opts["opt_invert"]:
-        re_match = not re_match    
-    if re_match and not opts["opt_and"]:
-        final_return = True
-        print '\n'.join(doc)
-        if opts["opt_quit"]:
-            sys.exit(0)
-    if re_match and opts["opt_and"] and not False in re_matches.values():
+        re_match = not re_match
+    if re_match and (opts["opt_since"] or opts["opt_until"]):
+        return in_time_range(opts, header_time(doc))
+    return re_match
+
+def format_doc(opts, fn, offset, doc):
+    # What gets written for a matching record: the record itself, or with -J
+    # one line of JSON holding the file, offset, header fields and either the
+    # -k fields or, without -k, the record text.
+    if not opts["opt_json"]:
+        return doc
+    rec = parse_header(doc)
+    rec["file"] = fn
+    rec["offset"] = offset
+    text = doc.decode("utf-8", "replace")
+    if field_re:
+        fields = {}
+        for name, value in field_re.findall(text):
+            fields.setdefault(name, value)
+        rec["fields"] = fields
+    else:
+        rec["record"] = text
+    return (json.dumps(rec, sort_keys=True) + "\n").encode("utf-8")
+
+class Output:
+    # Collects what's to be written and hands it to fd in OUTPUT_BUFFER sized
+    # writes, instead of one write per record. Everything written is bytes;
+    # fd is stdout's binary side, so text print()ed to stdout is flushed first
+    # to keep the two in order.
+    def __init__(self, fd):
+        self.fd = fd
+        self.buf = []
+        self.size = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= OUTPUT_BUFFER:
+            self.flush()
+
+    def flush(self):
+        sys.stdout.flush()
+        if self.buf:
+            self.fd.write(b"".join(self.buf))
+            self.buf, self.size = [], 0
+        self.fd.flush()
+
+    def close(self):
+        self.flush()
+        if isinstance(self.fd, Writer):
+            self.fd.close()
+
+class Writer:
+    # -w: the file is written by a thread of its own, fed through a queue of
+    # at most WRITE_QUEUE blocks, so a slow disk only holds up matching once
+    # that many are waiting.
+    def __init__(self, fn):
+        self.fn = fn
+        self.fd = open(fn, "wb")
+        self.error = None
+        self.queue = queue.Queue(WRITE_QUEUE)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        data = self.queue.get()
+        while data is not None:
+            try:
+                self.fd.write(data)
+                if self.queue.empty():
+                    self.fd.flush()
+            except IOError as e:
+                # keep draining so write() never blocks on a dead thread
+                self.error = e
+            data = self.queue.get()
+        try:
+            self.fd.close()
+        except IOError as e:
+            self.error = e
+
+    def write(self, data):
+        if self.error:
+            print("%s: %s" % (self.fn, self.error.strerror))
+            os._exit(1)
+        self.queue.put(data)
+
+    def flush(self):
+        # the thread flushes whenever it catches up
+        pass
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            print("%s: %s" % (self.fn, self.error.strerror))
+
+class Progress:
+    # -w: with the records going to a file, stdout gets a line every
+    # PROGRESS_INTERVAL seconds saying how far we've got.
+    def __init__(self):
+        self.records, self.matches, self.nbytes = 0, 0, 0
+        self.t0 = self.last = time.time()
+        self.last_records = 0
+
+    def tick(self):
+        now = time.time()
+        if now - self.last >= PROGRESS_INTERVAL:
+            self.report(now)
+
+    def report(self, now=None):
+        now = now or time.time()
+        rate = (self.records - self.last_records) / max(now - self.last, 0.001)
+        print("%d records scanned (%d/s), %d matches, %.1f MB in %.0f sec" % (self.records,
+            rate, self.matches, self.nbytes / 1048576.0, now - self.t0))
+        sys.stdout.flush()
+        self.last, self.last_records = now, self.records
+
+def close_output():
+    output.close()
+    if progress:
+        progress.report()
+
+def grep_doc(opts, fn, offset, doc):
+    global final_return
+    if progress:
+        progress.records += 1
+    if match_doc(opts, doc):
         final_return = True
-        print '\n'.join(doc)
+        if progress:
+            progress.matches += 1
+        output.write(format_doc(opts, fn, offset, doc))
         if opts["opt_quit"]:
+            output.flush()
             sys.exit(0)
-        
-
-def read_and_grep(opts, fn, fd):
-    global doc_start_re, doc_end_re
-    doc_start = False
-    line = fd.readline()
-    doc = False
-    while line:
-        line = line.rstrip('\r\n')
-        if doc_start_re.match(line):
-            doc_start = True
-            doc = [line]
-        elif doc_start == True:
-            doc += [ line ]
-            if doc_end_re.match(line):
-                grep_doc(opts, doc)
-                doc = False
-                doc_start = False
-        line = fd.readline()
-        if doc and len(doc) > 3000:
-            print("*** File %s doesn't appear to be consolidated-engine log." % fn)
+
+class RecordSplitter:
+    # Carves records out of the log in large blocks. Rather than running the
+    # start/end regexps on every line, we bytes.find() for lines ending in "=",
+    # which is the only place a header or a delimiter can be, and only look
+    # closer at those.
+    def __init__(self, fn):
+        self.fn = fn
+        self.buf = b""
+        self.offset = 0         # file offset of buf[0]
+        self.scan = 0           # index in buf of the first line not yet looked at
+        self.start = -1         # index in buf of the open record's header line
+        self.term = None        # "=\n", or "=\r\n" for files that came off windows
+
+    def feed(self, data):
+        # returns [(offset, record), ...] for every record completed by data
+        buf = self.buf + data if self.buf else data
+        if self.term is None:
+            nl = buf.find(b"\n")
+            if nl < 0:
+                self.buf = buf
+                return []
+            self.term = b"=\r\n" if buf[nl - 1:nl] == b"\r" else b"=\n"
+        term, tlen = self.term, len(self.term)
+        pos, start = self.scan, self.start
+        docs = []
+
+        i = buf.find(term, pos)
+        while i >= 0:
+            eol = i + tlen
+            bol = buf.rfind(b"\n", pos, i) + 1 or pos
+            line = buf[bol:i + 1]
+            if not line.strip(b"="):
+                if start >= 0:
+                    docs.append((self.offset + start, buf[start:eol]))
+                    start = -1
+            elif doc_start_re.match(line):
+                start = bol
+            pos = eol
+            i = buf.find(term, pos)
+
+        if start >= 0:
+            if buf.count(b"\n", start) > MAX_DOC_LINES:
+                print("*** File %s doesn't appear to be consolidated-engine log." % self.fn)
+                sys.exit(1)
+            cut = start
+        else:
+            cut = buf.rfind(b"\n", pos) + 1 or pos
+        self.buf = buf[cut:]
+        self.offset += cut
+        self.scan = max(pos - cut, 0)
+        self.start = start - cut if start >= 0 else -1
+        return docs
+
+    def finish(self):
+        # a final ===== line without a trailing newline still closes the record
+        if self.buf.endswith(b"="):
+            return self.feed(self.term[1:] if self.term else b"\n")
+        return []
+
+class BackgroundReader:
+    # Decompresses in its own thread and hands blocks over through a short
+    # queue, so inflating the next block overlaps matching the current one.
+    # zlib and zstandard both drop the GIL while they work.
+    def __init__(self, fd, depth=4):
+        self.fd = fd
+        self.eof = False
+        self.queue = queue.Queue(depth)
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        try:
+            data = self.fd.read(CHUNK_SIZE)
+            while data:
+                self.queue.put(data)
+                data = self.fd.read(CHUNK_SIZE)
+            self.queue.put(b"")
+        except Exception as e:
+            self.queue.put(e)
+
+    def read(self, size=-1):
+        # blocks come back at the size they were decompressed at
+        if self.eof:
+            return b""
+        data = self.queue.get()
+        if isinstance(data, Exception):
+            raise data
+        if not data:
+            self.eof = True
+        return data
+
+def compression(fn):
+    # gzip and zstd are recognised by their magic number, so rotated logs
+    # work whatever they've been renamed to
+    fd = open(fn, "rb")
+    magic = fd.read(4)
+    fd.close()
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic == ZSTD_MAGIC:
+        return "zstd"
+    return None
+
+def open_input(fn):
+    # Returns (fd, compressed). zstd uses the zstandard module if it's
+    # installed, otherwise the zstd binary.
+    ctype = compression(fn)
+    if ctype == "gzip":
+        return BackgroundReader(gzip.open(fn, "rb")), True
+    if ctype == "zstd":
+        if zstandard:
+            fd = open(fn, "rb")
+            dctx = zstandard.ZstdDecompressor()
+            try:
+                reader = dctx.stream_reader(fd, read_across_frames=True)
+            except TypeError:
+                reader = dctx.stream_reader(fd)
+            return BackgroundReader(reader), True
+        try:
+            proc = subprocess.Popen(["zstd", "-dcq", fn], stdout=subprocess.PIPE)
+        except OSError:
+            print("%s: zstd compressed, but no zstandard module or zstd binary found" % fn)
             sys.exit(1)
+        return proc.stdout, True
+    return open(fn, "rb"), False
+
+def report_stats(fn, nbytes, secs, compressed):
+    mb = nbytes / 1048576.0
+    note = ""
+    if compressed:
+        note = " (%.1f MB compressed)" % (os.path.getsize(fn) / 1048576.0)
+    sys.stderr.write("%s: %.1f MB%s in %.2f sec, %.1f MB/s\n" % (fn, mb, note, secs,
+        mb / secs if secs > 0 else 0))
+
+def seek_record(fd, splitter, start):
+    # Positions fd (and the splitter's idea of where it is) at the first full
+    # line at or after start. A record whose header is before start is skipped.
+    fd.seek(max(start - 1, 0))
+    if start > 0:
+        fd.readline()
+    splitter.offset = fd.tell()
+
+def read_and_grep(opts, fn, fd, splitter, final=True, end=sys.maxsize):
+    # Greps the records whose header starts before end. Returns the number of
+    # bytes read.
+    nbytes = 0
+    data = fd.read(CHUNK_SIZE)
+    while data:
+        nbytes += len(data)
+        for offset, doc in splitter.feed(data):
+            if offset >= end:
+                return nbytes
+            grep_doc(opts, fn, offset, doc)
+        if progress:
+            progress.nbytes += len(data)
+            progress.tick()
+        if splitter.offset >= end:
+            return nbytes
+        data = fd.read(CHUNK_SIZE)
+    if final:
+        for offset, doc in splitter.finish():
+            if offset < end:
+                grep_doc(opts, fn, offset, doc)
+    return nbytes
+
+def parse_when(s):
+    # --since/--until: "YYYY-MM-DD[ HH[:MM[:SS]]]", a "T" works too. We
+    # compare against the same number of leading characters of the record's
+    # timestamp, so --until 2016-06-01T10:05 takes in all of 10:05.
+    if not when_re.match(s):
+        return None
+    return s.replace(" ", "T").encode()
+
+def in_time_range(opts, ts):
+    if ts is None:
+        return False
+    since, until = opts["opt_since"], opts["opt_until"]
+    if since and ts[:len(since)] < since:
+        return False
+    if until and ts[:len(until)] > until:
+        return False
+    return True
+
+def next_header(fd, offset, limit):
+    # (offset, timestamp) of the first record header starting in
+    # [offset, limit), or (None, None)
+    fd.seek(max(offset - 1, 0))
+    if offset > 0:
+        fd.readline()
+    pos = fd.tell()
+    while pos < limit:
+        line = fd.readline()
+        if not line:
+            break
+        header = line.rstrip(b"\r\n")
+        if header.endswith(b"=") and doc_start_re.match(header):
+            return pos, header_time(header)
+        pos += len(line)
+    return None, None
+
+def bisect_offset(fd, size, past):
+    # Binary search over byte offsets for the first record whose timestamp
+    # past() is true of, resynchronising on the next header line each probe.
+    # Returns (lo, hi): every header before lo is not past, and the first
+    # header at or after hi is past, so the answer is somewhere in between.
+    # Stops once that's down to BISECT_MIN.
+    lo, hi = 0, size
+    while hi - lo > BISECT_MIN:
+        mid = (lo + hi) // 2
+        offset, ts = next_header(fd, mid, hi)
+        if offset is None or (ts is not None and past(ts)):
+            hi = mid
+        else:
+            lo = offset + 1
+    return lo, hi
+
+def time_range(opts, fn):
+    # The byte range of fn that can hold records inside --since/--until.
+    # consolidated-engine.log is written in time order, so a window of a few
+    # minutes in a 20 GB file comes down to reading a few MB.
+    size = os.path.getsize(fn)
+    fd = open(fn, "rb")
+    start, end = 0, size
+    since, until = opts["opt_since"], opts["opt_until"]
+    if since:
+        start = bisect_offset(fd, size, lambda ts: ts[:len(since)] >= since)[0]
+    if until:
+        end = bisect_offset(fd, size, lambda ts: ts[:len(until)] > until)[1]
+    fd.close()
+    return start, max(start, end)
+
+def header_time(doc):
+    # "qns01 [2016-06-01 00:06:54,120] =====" -> "2016-06-01T00:06:54,120"
+    eol = doc.find(b"\n")
+    m = header_time_re.search(doc, 0, eol if eol >= 0 else len(doc))
+    if not m:
+        return None
+    return m.group(1) + b"T" + m.group(2)
+
+def parse_header(doc):
+    # {"time": ..., "component": ..., "thread": ...} from the header line.
+    # The timestamp is usually in the brackets with the qns instance in front
+    # of it, but if it's the other way round the brackets hold the thread.
+    eol = doc.find(b"\n")
+    m = header_re.match(doc, 0, eol if eol >= 0 else len(doc))
+    if not m:
+        return {}
+    rec = {}
+    ts = header_time(doc)
+    if ts:
+        rec["time"] = ts.decode("utf-8", "replace")
+    for name, value in (("component", m.group(1)), ("thread", m.group(2))):
+        if not header_time_re.search(value):
+            rec[name] = value.decode("utf-8", "replace")
+    return rec
+
+def index_keys(doc):
+    # the diameter session id, framed IP, MSISDN and IMSI values in a record.
+    # Session keys from the policy tags are url-encoded, so we keep both forms.
+    keys = []
+    for key in index_key_re.findall(doc):
+        if key not in keys:
+            keys.append(key)
+        if b"%3B" in key:
+            key = key.replace(b"%3B", b";")
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+def index_path(fn):
+    return fn + ".idx"
+
+def read_index_header(ifd):
+    # returns [inode, indexed log size, head length, head crc, index length]
+    ifd.seek(0)
+    fields = ifd.readline().split()
+    if len(fields) != 7 or fields[:2] != [b"#engine-index", b"1"]:
+        return None
+    return [int(fields[2]), int(fields[3]), int(fields[4]), int(fields[5], 16), int(fields[6])]
+
+def head_crc(fd, length):
+    fd.seek(0)
+    return zlib.crc32(fd.read(length)) & 0xffffffff
+
+def update_index(fn, verbose=False):
+    # Brings the sidecar index for fn up to date and returns its path, or None
+    # if fn can't be indexed. The index is a text file, one line per record:
+    #     <byte offset> <header timestamp> <key> <key> ...
+    # under a fixed width header recording the log's inode, how far into the
+    # log we've indexed, a crc of the log's first 4k and how much of the index
+    # itself is valid. If the log was rotated or truncated we start over,
+    # otherwise only the records written since last time are read.
+    if compression(fn):
+        if verbose:
+            print("%s: compressed files can't be indexed" % fn)
+        return None
+    idx = index_path(fn)
+    fd = open(fn, "rb")
+    f_stat = os.fstat(fd.fileno())
+    try:
+        ifd = open(idx, "r+b")
+    except IOError:
+        try:
+            ifd = open(idx, "w+b")
+        except IOError:
+            if verbose:
+                print("%s: unable to write index" % idx)
+            return None
+
+    header = read_index_header(ifd)
+    if header:
+        ino, size, head_len, crc, idx_len = header
+        if ino != f_stat.st_ino or size > f_stat.st_size or head_crc(fd, head_len) != crc:
+            header = None
+    if not header:
+        head_len = min(f_stat.st_size, INDEX_HEAD_BYTES)
+        ino, size, crc = f_stat.st_ino, 0, head_crc(fd, head_len)
+        idx_len = len(INDEX_HEADER % (0, 0, 0, 0, 0))
+
+    # anything past idx_len is left over from an update that didn't finish
+    ifd.truncate(idx_len)
+    ifd.seek(idx_len)
+    fd.seek(size)
+    splitter = RecordSplitter(fn)
+    splitter.offset = size
+    records = 0
+    data = fd.read(CHUNK_SIZE)
+    while data:
+        lines = []
+        for offset, doc in splitter.feed(data):
+            lines.append(b" ".join([str(offset).encode(), header_time(doc) or b"-"] + index_keys(doc)))
+        if lines:
+            ifd.write(b"\n".join(lines) + b"\n")
+            records += len(lines)
+        data = fd.read(CHUNK_SIZE)
+    # the open record (if any) gets indexed next time, once it's complete
+    size = splitter.offset
+
+    idx_len = ifd.tell()
+    ifd.seek(0)
+    ifd.write((INDEX_HEADER % (ino, size, head_len, crc, idx_len)).encode())
+    ifd.close()
+    if verbose:
+        print("%s: %d new records indexed, %d bytes of %s covered" % (idx, records, size, fn))
+    return idx
+
+def index_lookup(idx, keys, icase):
+    # Returns {key: set(offsets)} for each key found in the index. All the
+    # keys go through one trie regex over the mmapped index, anchored so a key
+    # only matches a whole space separated field.
+    hits = dict((k, set()) for k in keys)
+    ifd = open(idx, "rb")
+    if os.fstat(ifd.fileno()).st_size == 0:
+        return hits
+    flags = re.MULTILINE | (re.IGNORECASE if icase else 0)
+    key_re = re.compile(b"(?<![^ \\n])(" + to_bytes(trie_regex([to_str(k) for k in keys], True)) +
+        b")(?![^ \\n])", flags)
+    data = mmap.mmap(ifd.fileno(), 0, access=mmap.ACCESS_READ)
+    for m in key_re.finditer(data):
+        bol = data.rfind(b"\n", 0, m.start()) + 1
+        fields = data[bol:data.find(b"\n", m.end())].split(b" ")
+        key = m.group(1).lower() if icase else m.group(1)
+        # offset and timestamp fields aren't keys, even if a number matches them
+        if bol > 0 and key in hits and m.group(1) in fields[2:]:
+            hits[key].add(int(fields[0]))
+    data.close()
+    return hits
+
+def read_record(fn, fd, offset):
+    fd.seek(offset)
+    splitter = RecordSplitter(fn)
+    splitter.offset = offset
+    data = fd.read(65536)
+    while data:
+        docs = splitter.feed(data)
+        if docs:
+            return docs[0][1]
+        data = fd.read(65536)
+    docs = splitter.finish()
+    return docs[0][1] if docs else None
+
+def grep_indexed(opts, fn):
+    # -x: find the records holding the pattern keys through the index and
+    # seek straight to them. The records are still run through the patterns,
+    # so output is what a full scan gives for patterns that are whole keys.
+    # Returns False if the index can't be used and the file must be scanned.
+    idx = update_index(fn)
+    if not idx:
+        return False
+    hits = index_lookup(idx, grep_patterns.keys, opts["opt_icase"])
+    offsets = set()
+    if opts["opt_and"]:
+        # patterns that aren't keys at all (a host name, say) find nothing
+        # here; they're left for the match on the records themselves
+        found = [hits[key] for key in grep_patterns.keys if hits[key]]
+        if found:
+            offsets = found[0].intersection(*found[1:])
+    else:
+        for key in grep_patterns.keys:
+            offsets |= hits[key]
+
+    fd = open(fn, "rb")
+    for offset in sorted(offsets):
+        doc = read_record(fn, fd, offset)
+        if doc:
+            grep_doc(opts, fn, offset, doc)
+    return True
+
+def grep_range(task):
+    # Runs in a -j worker. Returns (docs, records, bytes read, seconds) where
+    # docs are the formatted matching records out of the records whose header
+    # line starts in [start, end). The
+    # first partial line is skipped, and we read past end as far as needed to
+    # finish a record that started before it. Compressed files can't be cut
+    # up, so they come through as a single range covering the whole stream.
+    opts, fn, start, end = task
+    if start < 0:
+        return ["%s: files does not exist or is not readable\n" % fn], 0, 0, 0
+    t0 = time.time()
+    fd, compressed = open_input(fn)
+    splitter = RecordSplitter(fn)
+    if start > 0:
+        seek_record(fd, splitter, start)
+    pos = splitter.offset
+
+    docs, records = [], 0
+    data = fd.read(min(CHUNK_SIZE, max(end - pos, 65536)))
+    while data:
+        for offset, doc in splitter.feed(data):
+            if offset >= end:
+                return docs, records, pos - start, time.time() - t0
+            records += 1
+            if match_doc(opts, doc):
+                docs.append(format_doc(opts, fn, offset, doc))
+                if opts["opt_quit"]:
+                    return docs, records, pos - start, time.time() - t0
+        pos += len(data)
+        # the splitter only holds on to an open record or a partial line, so
+        # once that starts past end everything in our range has been seen
+        if splitter.offset >= end:
+            return docs, records, pos - start, time.time() - t0
+        data = fd.read(min(CHUNK_SIZE, max(end - pos, 65536)))
+    for offset, doc in splitter.finish():
+        if offset < end:
+            records += 1
+            if match_doc(opts, doc):
+                docs.append(format_doc(opts, fn, offset, doc))
+    return docs, records, pos - start, time.time() - t0
+
+def parallel_grep(opts, input_files):
+    # Every file is cut into RANGE_SIZE pieces and the pieces are searched
+    # across a process pool. imap() hands results back in task order, so the
+    # output is the same as a serial run. Returns True if anything matched.
+    tasks = []
+    for fn in input_files:
+        if not (os.path.isfile(fn) and os.access(fn, os.R_OK)):
+            tasks.append((opts, fn, -1, -1))
+            continue
+        if compression(fn):
+            tasks.append((opts, fn, 0, sys.maxsize))
+            continue
+        first, size = 0, os.path.getsize(fn)
+        if opts["opt_since"] or opts["opt_until"]:
+            first, size = time_range(opts, fn)
+        tasks += [(opts, fn, start, min(start + RANGE_SIZE, size))
+            for start in range(first, size, RANGE_SIZE)]
+    last_task = dict((task[1], n) for n, task in enumerate(tasks))
+
+    # the workers are forked after grep_patterns is set up, so they inherit it
+    if hasattr(multiprocessing, "get_context"):
+        pool = multiprocessing.get_context("fork").Pool(opts["opt_jobs"])
+    else:
+        pool = multiprocessing.Pool(opts["opt_jobs"])
+    matched = False
+    nbytes, secs = 0, 0
+    try:
+        for n, (docs, records, task_bytes, task_secs) in enumerate(pool.imap(grep_range, tasks)):
+            fn, start, end = tasks[n][1:]
+            if start < 0:
+                output.flush()
+                sys.stdout.write(docs[0])
+                continue
+            if progress:
+                progress.records += records
+                progress.matches += len(docs)
+                progress.nbytes += task_bytes
+                progress.tick()
+            for doc in docs:
+                matched = True
+                output.write(doc)
+                if opts["opt_quit"]:
+                    return True
+            # worker seconds, not wall clock, when a file was split up
+            nbytes, secs = nbytes + task_bytes, secs + task_secs
+            if opts["opt_stats"] and last_task[fn] == n:
+                report_stats(fn, nbytes, secs, end == sys.maxsize)
+            if last_task[fn] == n:
+                nbytes, secs = 0, 0
+    finally:
+        pool.terminate()
+    return matched
 
 def grep(opts, fn):
+    if opts["opt_index"] and grep_indexed(opts, fn):
+        return
     try:
-        fd = open(fn, "r")
+        fd, compressed = open_input(fn)
     except:
-        print("%s: Unable to read or access", fd)
+        print("%s: Unable to read or access" % fn)
         sys.exit(1)
-    orig_stat = os.stat(fn)
 
-    read_and_grep(opts, fn, fd)
+    t0 = time.time()
+    splitter = RecordSplitter(fn)
+    end = sys.maxsize
+    if (opts["opt_since"] or opts["opt_until"]) and not compressed:
+        start, end = time_range(opts, fn)
+        seek_record(fd, splitter, start)
+    nbytes = read_and_grep(opts, fn, fd, splitter, end=end)
+    if opts["opt_stats"]:
+        report_stats(fn, nbytes, time.time() - t0, compressed)
 
-    if opts["opt_tailf"]:
-        current_pos = fd.tell()
+class Inotify:
+    # Just enough of inotify(7) for -f. We watch the directories the files
+    # are in rather than the files, so a log being rotated and recreated
+    # shows up as well as writes to it.
+    def __init__(self, dirs):
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.watches = {}
+        for d in dirs:
+            wd = libc.inotify_add_watch(self.fd, to_bytes(d), IN_MODIFY | IN_MOVED_TO | IN_CREATE)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch " + d)
+            self.watches[wd] = d
+
+    def wait(self, timeout):
+        # Returns the set of paths that changed, or None if we timed out or the
+        # kernel's event queue overflowed, meaning everything should be checked.
+        # Everything queued is drained at once, so a burst of writes turns
+        # into one read per file.
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return None
+        paths = set()
         while True:
-            time.sleep(0.1)
-            if os.path.isfile(fn):
-                f_stat = os.stat(fn)
-            else:
-                continue
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return paths
+                raise
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = struct.unpack_from("iIII", buf, pos)
+                name = buf[pos + 16:pos + 16 + length].rstrip(b"\0")
+                pos += 16 + length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if wd in self.watches:
+                    paths.add(os.path.join(self.watches[wd], to_str(name)))
 
-            if orig_stat.st_ino != f_stat.st_ino:
-                try:
-                    fd = open(fn, "r")
-                except:
-                    continue
-                orig_stat = f_stat
-                current_pos = 0
-            if f_stat.st_size < current_pos:
-                fd.seek(0)
-
-            if f_stat.st_size == current_pos:
-                continue
+class Follower:
+    # One file being followed. Rotation shows up as a new inode (whatever was
+    # still written to the old file is read first), truncation as the file
+    # getting smaller than where we are.
+    def __init__(self, opts, fn):
+        self.opts, self.fn = opts, fn
+        self.path = os.path.abspath(fn)
+        self.open()
+        if opts["opt_since"]:
+            seek_record(self.fd, self.splitter, time_range(opts, fn)[0])
+
+    def open(self):
+        self.fd = open(self.fn, "rb")
+        self.inode = os.fstat(self.fd.fileno()).st_ino
+        self.splitter = RecordSplitter(self.fn)
+
+    def read(self):
+        # everything that's there, in CHUNK_SIZE blocks
+        read_and_grep(self.opts, self.fn, self.fd, self.splitter, final=False)
+        output.flush()
+
+    def check(self):
+        try:
+            f_stat = os.stat(self.fn)
+        except OSError:
+            return          # rotated away, not recreated yet
+        if f_stat.st_ino != self.inode:
+            self.read()
+            self.fd.close()
+            try:
+                self.open()
+            except IOError:
+                return
+        elif f_stat.st_size < self.fd.tell():
+            self.fd.seek(0)
+            self.splitter = RecordSplitter(self.fn)
+        if f_stat.st_size > self.fd.tell():
+            self.read()
+
+def follow(opts, input_files):
+    followers = []
+    for fn in input_files:
+        if compression(fn):
+            print("%s: -f can't follow a compressed file" % fn)
+            sys.exit(1)
+        followers.append(Follower(opts, fn))
+    for f in followers:
+        f.read()
 
-            read_and_grep(opts, fn, fd)
-        # tailf option end
-            
-        
+    notify = None
+    if libc:
+        try:
+            notify = Inotify(set(os.path.dirname(f.path) for f in followers))
+        except OSError:
+            pass
+
+    while True:
+        if notify:
+            # a timeout now and then costs one stat() per file, and covers
+            # anything inotify can't see (NFS, say)
+            changed = notify.wait(1.0)
+            for f in followers:
+                if changed is None or f.path in changed:
+                    f.check()
+        else:
+            time.sleep(0.1)
+            for f in followers:
+                f.check()
+        if progress:
+            progress.tick()
 
 def display_short_help(cmd):
     print("Usage: %s [options] PATTERN [file(s)]" % cmd)
@@ -107,15 +1026,18 @@ def display_short_help(cmd):
 def display_help(cmd):
     print("Usage: %s [options] PATTERN [file(s)]" % cmd)
     print("  If no filenames are given, default will be to use consolidated-engine.log")
+    print("  gzip and zstd compressed files are read directly")
     print("Options:")
     print("  -e PATTERN, --regexp=PATTERN")
     print("        Use PATTERN as the pattern. This can be used to specify multiple")
-    print("        search patterns")
+    print("        search patterns. Each pattern matches within one line of a record;")
+    print("        ^ and $ are the start and end of that line")
     print("  -a, --and")
     print("        For multiple patterns, make them act as a logical 'and' (default: off)")
-    print("        Warning: slower")
+    print("        With -v, select documents that don't match all of the patterns")
     print("  -F FILE, --file FILE")
-    print("        Obtain patterns from FILE, one per line. [NOT YET IMPLEMENTED]")
+    print("        Obtain patterns from FILE, one per line. Plain strings (IMSIs, MSISDNs,")
+    print("        session ids) are matched together in one pass, so large lists are cheap")
     print("  -v, --invert-match")
     print("        Invert the sense of matching, to select non-matching documents")
     print("  -i, --ignore-case")
@@ -124,15 +1046,40 @@ def display_help(cmd):
     print("        Exit after the first match")
     print("  -f, --follow")
     print("        Follow in the manner of tail -f. If truncated, it will")
-    print("        seek back to beginning")
+    print("        seek back to beginning; if rotated, it picks up the new file. Several")
+    print("        files can be followed at once. Uses inotify where available")
+    print("  -J, --json")
+    print("        Write each matching record as one line of JSON (NDJSON) with its file,")
+    print("        byte offset, header time/component/thread and the record text")
+    print("  -k NAME, --field=NAME")
+    print("        With -J, extract NAME: value (or NAME=value) from each record into")
+    print("        \"fields\" instead of including the record text. Can be repeated")
+    print("  -j N, --jobs=N")
+    print("        Search with N processes (0 = one per cpu). Files are split into")
+    print("        pieces on record boundaries; output order is the same as with -j 1")
+    print("  --build-index")
+    print("        Build or bring up to date FILE.idx for each file, then exit. The index")
+    print("        holds each record's offset, timestamp, session id, framed IP, MSISDN")
+    print("        and IMSI. Only records added since the last run are read")
+    print("  -x, --index")
+    print("        Look the patterns up as whole keys in FILE.idx (updating it first)")
+    print("        and read only the records that hold them. Plain strings only; with -a")
+    print("        at least one of the patterns has to be a key")
+    print("  --since=TIME, --until=TIME")
+    print("        Only records with a header timestamp in this range (inclusive). TIME is")
+    print("        YYYY-MM-DD[ HH[:MM[:SS]]]. The file is binary searched for the start and")
+    print("        end, so only that part of it is read")
+    print("  --stats")
+    print("        Print the size and MB/s for each file to stderr when it's done")
     print("  -w FILE, --write FILE")
-    print("        write output to FILE instead of to standard out.")
-    print("        Instead, stdout will print a note every time a match is found")
-    print("        NOT YET IMPLEMENTED")
+    print("        Write output to FILE instead of to standard out. The file is written")
+    print("        from a separate thread so matching doesn't wait on the disk, and")
+    print("        stdout gets a progress line (records scanned and per second, matches,")
+    print("        MB read) every %d seconds and when done" % PROGRESS_INTERVAL)
     sys.exit(0)
 
 def main(argc, argv):
-    global grep_patterns, final_return
+    global grep_patterns, final_return, field_re, output, progress
     if argc == 1:
         display_short_help(argv[0])
 
@@ -142,13 +1089,17 @@ def main(argc, argv):
     options = { "opt_icase" : False, "opt_invert" : False, 
         "opt_ifile" : [], "opt_patterns" : [], "opt_quit" : False,
         "opt_follow" : False, "opt_outfile" : False, "opt_tailf" : False,
-        "opt_and" : False,
+        "opt_and" : False, "opt_jobs" : 1, "opt_stats" : False,
+        "opt_index" : False, "opt_build_index" : False,
+        "opt_since" : None, "opt_until" : None, "opt_json" : False,
+        "opt_fields" : [],
         }
 
     try:
-        opts, args = getopt.gnu_getopt(argv[1:], "F:h?ive:qw:fa", 
+        opts, args = getopt.gnu_getopt(argv[1:], "F:h?ive:qw:faj:xJk:", 
             ["file=", "help", "ignore-case", "invert-match", "regexp=", "quit",
-             "write=", "follow", "and"])
+             "write=", "follow", "and", "jobs=", "stats", "index", "build-index",
+             "since=", "until=", "json", "field="])
     except getopt.GetoptError:
         display_short_help(argv[0])
 
@@ -171,9 +1122,33 @@ def main(argc, argv):
             options["opt_outfile"] = arg
         elif opt in ("-f", "--follow"):
             options["opt_tailf"] = True;
+        elif opt == "--stats":
+            options["opt_stats"] = True
+        elif opt in ("-J", "--json"):
+            options["opt_json"] = True
+        elif opt in ("-k", "--field"):
+            options["opt_fields"] += [ arg ]
+        elif opt in ("-x", "--index"):
+            options["opt_index"] = True
+        elif opt == "--build-index":
+            options["opt_build_index"] = True
+        elif opt in ("--since", "--until"):
+            when = parse_when(arg)
+            if not when:
+                print("%s: expected YYYY-MM-DD[ HH[:MM[:SS]]]" % arg)
+                sys.exit(1)
+            options["opt_" + opt[2:]] = when
+        elif opt in ("-j", "--jobs"):
+            try:
+                options["opt_jobs"] = int(arg)
+            except ValueError:
+                display_short_help(argv[0])
+            if options["opt_jobs"] < 1:
+                options["opt_jobs"] = multiprocessing.cpu_count()
        
 
-    if len(options["opt_ifile"]) == 0 and len(options["opt_patterns"]) == 0:
+    if len(options["opt_ifile"]) == 0 and len(options["opt_patterns"]) == 0 \
+            and not options["opt_build_index"]:
         if len(args) == 0:
             display_short_help(argv[0])
         else:
@@ -183,25 +1158,35 @@ def main(argc, argv):
     if len(options["opt_ifile"]) > 0:
         for f in options["opt_ifile"]:
             try:
-                fd = open(f, "r")
+                fd = open(f, "rb")
             except:
                 print("%s: unable to open for reading" % f)
+                sys.exit(1)
             line = fd.readline()
             while line:
-                options["opt_patterns"] += [ line.rstrip('\r\n') ]
+                options["opt_patterns"] += [ to_str(line.rstrip(b'\r\n')) ]
                 line = fd.readline()
 
-    for p in options["opt_patterns"]:
+    flags = re.MULTILINE
+    if options["opt_icase"]:
+        flags |= re.IGNORECASE
+    grep_patterns = PatternSet(options["opt_patterns"], flags)
+    if options["opt_fields"]:
+        # NAME: value or NAME=value, the value running to whitespace or a delimiter
+        field_re = re.compile(r"(?<![\w-])(%s)\s*[:=]\s*([^\s,\"'\[\]{}]+)" %
+            "|".join(re.escape(f) for f in options["opt_fields"]))
+    if options["opt_outfile"]:
         try:
-            if options["opt_icase"]:
-                regex = re.compile(p, re.IGNORECASE)
-            else:
-                regex = re.compile(p)
-        except:
-            print("%s: invalid regexp" % p)
+            output = Output(Writer(options["opt_outfile"]))
+        except IOError as e:
+            print("%s: %s" % (options["opt_outfile"], e.strerror))
             sys.exit(1)
-        grep_patterns += [ regex ]
-            
+        progress = Progress()
+        # also covers -q, ^C out of -f and the other sys.exit()s
+        atexit.register(close_output)
+    else:
+        output = Output(getattr(sys.stdout, "buffer", sys.stdout))
+
     input_files = []
     if len(args) == 0:
         if os.path.isfile("/var/log/broadhop/consolidated-engine.log"):
@@ -213,15 +1198,43 @@ def main(argc, argv):
             sys.exit(1)
     else:
         input_files = args
-        if len(input_files) != 1 and options["opt_tailf"] == True:
-            print("Error: -f option only works on exactly one file currently.");
-            sys.exit(1);
+
+    if options["opt_build_index"]:
+        for fn in input_files:
+            update_index(fn, verbose=True)
+        sys.exit(0)
+
+    if options["opt_index"]:
+        if grep_patterns.keys is None or options["opt_invert"] or options["opt_tailf"]:
+            sys.stderr.write("-x only works with plain string patterns, without -v or -f; scanning\n")
+            options["opt_index"] = False
+        else:
+            options["opt_jobs"] = 1
+
+    if options["opt_jobs"] > 1 and not options["opt_tailf"]:
+        final_return = parallel_grep(options, input_files)
+        output.flush()
+        sys.exit(0 if final_return else 1)
+
+    if options["opt_tailf"]:
+        readable = []
+        for fn in input_files:
+            if os.path.isfile(fn) and os.access(fn, os.R_OK):
+                readable.append(fn)
+            else:
+                print("%s: files does not exist or is not readable" % fn)
+        sys.stdout.flush()
+        if not readable:
+            sys.exit(1)
+        follow(options, readable)
 
     for fn in input_files:
         if os.path.isfile(fn) and os.access(fn, os.R_OK):
             grep(options, fn)
         else:
+            output.flush()
             print("%s: files does not exist or is not readable" % fn)
+    output.flush()
 
     if final_return:
         sys.exit(0)
@@ -4,12 +4,74 @@
 # Not official Cisco software. Only supported by Allen Garvin <algarvin@cisco.com>
 
 from suds.client import Client
+from suds.cache import ObjectCache
 from suds.sax.element import Element
+from suds.transport import Reply, TransportError
+from suds.transport.https import HttpAuthenticated
+from multiprocessing.pool import ThreadPool
+from io import BytesIO
 import argparse
+import os
+import socket
 import sys
+import threading
+import time
+try:
+    import httplib
+    from urlparse import urlsplit
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlsplit
 
-def make_connect():
-    c = Client("https://lbvip01:8443/ua/wsdl/UnifiedApi.wsdl")
+WSDL = "https://lbvip01:8443/ua/wsdl/UnifiedApi.wsdl"
+
+# option: session key type
+KEY_TYPES = [
+    ("framed", "FramedIp"),
+    ("usum", "USuMCredential"),
+    ("netid", "NetworkId"),
+    ("mac", "MacAddress"),
+    ("user", "UserId"),
+    ("msisdn", "Msisdn"),
+]
+
+local = threading.local()
+
+class KeepAliveTransport(HttpAuthenticated):
+    # suds makes every call over a connection of its own (urllib2), and
+    # --batch makes thousands of them. This keeps one open per thread
+    # instead. The WSDL is still fetched the usual way.
+    def send(self, request):
+        self.addcredentials(request)
+        url = urlsplit(request.url)
+        path = url.path + ("?" + url.query if url.query else "")
+        conns = local.__dict__.setdefault("conns", {})
+        for attempt in (1, 2):
+            conn = conns.get(url.netloc)
+            if conn is None:
+                conn_class = httplib.HTTPSConnection if url.scheme == "https" else httplib.HTTPConnection
+                conn = conns[url.netloc] = conn_class(url.netloc, timeout=self.options.timeout)
+            try:
+                conn.request("POST", path, request.message, request.headers)
+                resp = conn.getresponse()
+                body = resp.read()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                # the server may have closed a connection we kept open
+                conn.close()
+                del conns[url.netloc]
+                if attempt == 2:
+                    raise TransportError(str(e), 0)
+        if resp.status in (202, 204):
+            return None
+        if resp.status >= 300:
+            raise TransportError(resp.reason, resp.status, BytesIO(body))
+        return Reply(resp.status, dict(resp.getheaders()), body)
+
+def make_connect(args, **options):
+    # The parsed WSDL is kept in args.cache for a day, so it's only fetched
+    # and parsed again after that
+    c = Client(args.wsdl, cache=ObjectCache(location=args.cache, days=1), **options)
     test_req = c.service.KeepAlive()
     if test_req.errorCode != 0:
         print("Test KeepAlive connection received error:\n")
@@ -17,44 +79,97 @@ def make_connect():
         exit(1)
     return c
 
+def session_key(client, rcode, what):
+    rkey = client.factory.create('ns0:SessionKeyType')
+    rkey.code = rcode + "Key"    
+    rkey.primary = "false"
+
+    rkeyf = client.factory.create('ns0:KeyFieldType')
+    rkeyf.code = rcode[0].lower() + rcode[1:]
+    rkeyf.value = what
+    rkey.keyField = rkeyf
+    return rkey
+
+def credential_ids(req):
+    # the credentialId of each session in a QuerySession response
+    ids = []
+    for i in req.session:
+        if "sessionObject" in i and isinstance(i.sessionObject, list):
+            for j in i.sessionObject[0]:
+                for k in list(j):
+                    if isinstance(k, list):
+                        for l in k:
+                            if "string" in l and isinstance(l.string, list) and len(l.string) > 1:
+                                if l.string[0] == "credentialId":
+                                    ids.append(l.string[1])
+    return ids
+
+def lookup(job):
+    # --batch: one key, to a line of output
+    rcode, what = job
+    client = local.client
+    try:
+        req = client.service.QuerySession(key=session_key(client, rcode, what))
+    except Exception as e:
+        return "%s\terror\tQuerySession call failed: %s" % (what, e)
+    if getattr(req, "errorCode", 0):
+        return "%s\terror\tAPI error: %s" % (what, req.errorMessage)
+    if not "session" in req:
+        return "%s\tnone" % what
+    return "%s\tfound\t%d\t%s" % (what, len(req.session), ",".join(credential_ids(req)))
+
+def batch(args):
+    # Looks up every key in args.batch, args.jobs at once, each worker with
+    # its own copy of the client (they aren't thread safe, but a clone
+    # reuses the parsed WSDL) and its own kept open connection. The lines
+    # come out in the order of the keys, as soon as each is known.
+    if args.remove or args.spr or args.balance:
+        print("--batch only looks sessions up. -r, -s and -b work on a single key")
+        sys.exit(1)
+    rcode = dict(KEY_TYPES)[args.type]
+    client = make_connect(args, transport=KeepAliveTransport())
+
+    def worker_init():
+        local.client = client.clone()
+
+    fd = sys.stdin if args.batch == "-" else open(args.batch)
+    keys = (line.strip() for line in fd)
+    jobs = ((rcode, k) for k in keys if k and not k.startswith("#"))
+
+    counts = {}
+    t0 = time.time()
+    pool = ThreadPool(args.jobs, worker_init)
+    for line in pool.imap(lookup, jobs):
+        status = line.split("\t")[1]
+        counts[status] = counts.get(status, 0) + 1
+        print(line)
+        sys.stdout.flush()
+    pool.close()
+    secs = time.time() - t0
+    total = sum(counts.values())
+    sys.stderr.write("%d keys in %.1f sec (%.1f/sec): %d found, %d none, %d errors\n" % (total, secs,
+        total / secs if secs else 0, counts.get("found", 0), counts.get("none", 0), counts.get("error", 0)))
+    sys.exit(1 if counts.get("error") else 0)
+
 def main(argv):
     quota_name = ''
 
     verbose = False
 
-    client = make_connect()
-
-
-    if args.framed:
-        rcode = "FramedIp"
-        what = args.framed
-    elif args.usum:
-        rcode = "USuMCredential"
-        what = args.usum
-    elif args.netid:
-        rcode = "NetworkId"
-        what = args.netid
-    elif args.mac:
-        rcode = "MacAddress"
-        what = args.mac
-    elif args.user:
-        rcode = "UserId"
-        what = args.user
+    if args.batch:
+        batch(args)
+
+    client = make_connect(args)
+
+    for option, rcode in KEY_TYPES:
+        what = getattr(args, option)
+        if what:
+            break
     else:
         print("No searches give. Use -h for help")
         sys.exit(1)
 
-
-    rkey = client.factory.create('ns0:SessionKeyType')
-    rkey.code = rcode + "Key"    
-    rkey.primary = "false"
-
-    rkeyf = client.factory.create('ns0:KeyFieldType')
-    rkeyf.code = rcode[0].lower() + rcode[1:]
-    rkeyf.value = what
-    rkey.keyField = rkeyf
-    # rkey.keyField = k
-    
+    rkey = session_key(client, rcode, what)
 
     print("Running query: ")
     print(rkey)
@@ -76,16 +191,11 @@ def main(argv):
             so = i.sessionObject[0]
             if not args.quiet:
                 print(so)
-            #print(type(so))
-            for j in so:
-                for k in list(j):
-                    if isinstance(k, list):
-                        for l in k:
-                            if "string" in l and isinstance(l.string, list) and len(l.string) > 1:
-                                key = l.string[0]
-                                value = l.string[1]
-                                if key == "credentialId":
-                                    id = value
+    ids = credential_ids(req)
+    if not ids and (args.balance or args.spr):
+        print("No credentialId in the session info")
+        sys.exit(1)
+    id = ids[-1] if ids else None
     d = dict(networkId = id)
     breq = None
     sreq = None
@@ -123,6 +233,12 @@ if __name__ == "__main__":
     parser.add_argument("-n", "--netid", help="Search based on network id")
     parser.add_argument("-m", "--mac", help="Search on MacAdress")
     parser.add_argument("-i", "--user", help="Search on username")
+    parser.add_argument("-M", "--msisdn", help="Search on MSISDN")
+    parser.add_argument("-B", "--batch", metavar="FILE", help="Look up every key in FILE (- for stdin), one a line, printing a line for each: key, found/none/error, then the number of sessions and their credentialIds or the error")
+    parser.add_argument("-t", "--type", default="framed", choices=[k for k, c in KEY_TYPES], help="with -B, what the keys are (default: framed)")
+    parser.add_argument("-j", "--jobs", default=8, type=int, help="with -B, queries to run at once (default: 8)")
+    parser.add_argument("--wsdl", default=WSDL, help="Unified API WSDL (default: %s)" % WSDL)
+    parser.add_argument("--cache", default=os.path.expanduser("~/.find-session-cache"), help="directory to keep the parsed WSDL in (default: ~/.find-session-cache)")
     parser.add_argument("-q", "--quiet", help="Quiet (no records printed)", action="store_true")
     parser.add_argument("-r", "--remove", help="Stop session", action="store_true")
     parser.add_argument("-s", "--spr", help="Print SPR info for returned user", action="store_true")
@@ -0,0 +1,300 @@
+#!/usr/bin/python
+# Benchmark and self-check for javaser.py, the Java serialization decoder
+# cc-sessions.py uses. There's no Java here, so it carries a small writer
+# for the same format (Strings, boxed Long/Double/Boolean, byte[], Object[],
+# ArrayList, HashSet, HashMap, repeated strings as back references).
+#
+# First every stream of a random corpus is decoded and compared with what
+# was written. Then large HashMaps, shaped like the Control Center session
+# maps, are decoded and timed in MB/s and objects/s for each --module.
+# --fuzz N decodes N damaged streams (bytes changed, inserted, cut off) and
+# reports any that fail with something other than JavaSerError. Works with
+# python2 and python3.
+
+# Not official Cisco software.
+
+import argparse
+import os
+import random
+import struct
+import sys
+import time
+import traceback
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+text_type = type(u"")
+try:
+    integer_types = (int, long)
+except NameError:
+    integer_types = (int,)
+SUID = 0x0507DAC1C31660D1
+
+
+class Writer(object):
+    # ObjectOutputStream for the python values it knows
+    def __init__(self):
+        self.out = bytearray(struct.pack(">HH", 0xACED, 5))
+        self.next_handle = 0
+        self.classes = {}
+        self.strings = {}
+
+    def handle(self):
+        self.next_handle += 1
+        return self.next_handle - 1
+
+    def reference(self, h):
+        self.out += struct.pack(">BI", 0x71, 0x7E0000 + h)
+
+    def utf(self, s):
+        # modified UTF-8
+        b = bytearray()
+        units = s.encode("utf-16-be")
+        for i in range(0, len(units), 2):
+            c = struct.unpack(">H", units[i:i + 2])[0]
+            if 0 < c < 0x80:
+                b.append(c)
+            elif c < 0x800:
+                b += struct.pack("BB", 0xC0 | c >> 6, 0x80 | c & 0x3F)
+            else:
+                b += struct.pack("BBB", 0xE0 | c >> 12, 0x80 | c >> 6 & 0x3F, 0x80 | c & 0x3F)
+        self.out += struct.pack(">H", len(b)) + b
+
+    def string(self, s):
+        if s in self.strings:
+            return self.reference(self.strings[s])
+        self.out.append(0x74)
+        self.utf(s)
+        self.strings[s] = self.handle()
+
+    def classdesc(self, name, flags, fields=()):
+        if name in self.classes:
+            return self.reference(self.classes[name])
+        self.out.append(0x72)
+        self.utf(name)
+        self.out += struct.pack(">qB", SUID, flags)
+        self.classes[name] = self.handle()
+        self.out += struct.pack(">H", len(fields))
+        for typ, fname, fcls in fields:
+            self.out.append(ord(typ))
+            self.utf(fname)
+            if fcls:
+                self.string(fcls)
+        self.out += b"\x78"             # no class annotation
+        if name in ("java.lang.Long", "java.lang.Double"):
+            self.classdesc("java.lang.Number", 2)
+        else:
+            self.out += b"\x70"         # no serializable superclass
+
+    def value(self, v):
+        out = self.out
+        if v is None:
+            out.append(0x70)
+        elif isinstance(v, (text_type, str)) and not isinstance(v, bytearray):
+            self.string(v if isinstance(v, text_type) else v.decode("utf-8"))
+        elif isinstance(v, bool):
+            out.append(0x73)
+            self.classdesc("java.lang.Boolean", 2, [("Z", "value", None)])
+            self.handle()
+            out += struct.pack(">?", v)
+        elif isinstance(v, integer_types):
+            out.append(0x73)
+            self.classdesc("java.lang.Long", 2, [("J", "value", None)])
+            self.handle()
+            out += struct.pack(">q", v)
+        elif isinstance(v, float):
+            out.append(0x73)
+            self.classdesc("java.lang.Double", 2, [("D", "value", None)])
+            self.handle()
+            out += struct.pack(">d", v)
+        elif isinstance(v, bytearray):
+            out.append(0x75)
+            self.classdesc("[B", 2)
+            self.handle()
+            out += struct.pack(">i", len(v)) + v
+        elif isinstance(v, tuple):
+            out.append(0x75)
+            self.classdesc("[Ljava.lang.Object;", 2)
+            self.handle()
+            out += struct.pack(">i", len(v))
+            for x in v:
+                self.value(x)
+        elif isinstance(v, list):
+            out.append(0x73)
+            self.classdesc("java.util.ArrayList", 3, [("I", "size", None)])
+            self.handle()
+            out += struct.pack(">iBBi", len(v), 0x77, 4, len(v))
+            for x in v:
+                self.value(x)
+            out.append(0x78)
+        elif isinstance(v, (set, frozenset)):
+            out.append(0x73)
+            self.classdesc("java.util.HashSet", 3)
+            self.handle()
+            out += struct.pack(">BBifi", 0x77, 12, 16, 0.75, len(v))
+            for x in v:
+                self.value(x)
+            out.append(0x78)
+        elif isinstance(v, dict):
+            out.append(0x73)
+            self.classdesc("java.util.HashMap", 3, [("F", "loadFactor", None), ("I", "threshold", None)])
+            self.handle()
+            out += struct.pack(">fiBBii", 0.75, 12, 0x77, 8, 16, len(v))
+            for k, x in v.items():
+                self.value(k)
+                self.value(x)
+            out.append(0x78)
+        else:
+            raise TypeError(repr(v))
+
+
+def dumps(*values):
+    w = Writer()
+    for v in values:
+        w.value(v)
+    return bytes(w.out)
+
+
+def plain(v):
+    # javaser.loads() output back to what the Writer was given
+    if isinstance(v, dict) and "_cls" in v:
+        name = v["_cls"].name
+        if name in ("java.lang.Long", "java.lang.Double", "java.lang.Boolean"):
+            return v["value"]
+        if name == "java.util.HashMap":
+            return dict((plain(k), plain(x)) for k, x in v["data"].items())
+        if name == "java.util.HashSet":
+            return set(plain(x) for x in v["data"])
+        if name == "java.util.ArrayList":
+            return [plain(x) for x in v["data"]]
+        raise TypeError(name)
+    if isinstance(v, list):
+        return tuple(plain(x) for x in v)
+    if isinstance(v, bytes) and not isinstance(v, text_type):
+        return bytearray(v)
+    return v
+
+
+def make_value(rnd, depth=0):
+    kind = rnd.randint(0, 9 if depth < 4 else 4)
+    if kind == 0:
+        return None
+    if kind == 1:
+        return rnd.choice([u"qns", u"lbvip02", u"", u"caf\u00e9", u"\u4e2d\u6587", u"a\0b",
+            u"\U0001F600 smile", u"user%d" % rnd.randint(0, 20)])
+    if kind == 2:
+        return rnd.randint(-2 ** 63, 2 ** 63 - 1)
+    if kind == 3:
+        return rnd.choice([True, False, 0.5, -1e300])
+    if kind == 4:
+        return bytearray(rnd.getrandbits(8) for i in range(rnd.randint(0, 40)))
+    if kind == 5:
+        return tuple(make_value(rnd, depth + 1) for i in range(rnd.randint(0, 5)))
+    if kind == 6:
+        return [make_value(rnd, depth + 1) for i in range(rnd.randint(0, 5))]
+    if kind == 7:
+        return set(u"k%d" % rnd.randint(0, 99) for i in range(rnd.randint(0, 5)))
+    return dict((u"k%d" % rnd.randint(0, 99), make_value(rnd, depth + 1)) for i in range(rnd.randint(0, 5)))
+
+
+def make_corpus(count, seed=1):
+    rnd = random.Random(seed)
+    return [[make_value(rnd) for i in range(rnd.randint(1, 3))] for n in range(count)]
+
+
+def make_sessions(count, seed=2):
+    # one big HashMap, a key per session, like controlCenterSessions holds
+    rnd = random.Random(seed)
+    return dict((u"%032X" % rnd.getrandbits(128), {u"RemoteIpAddress": u"10.%d.%d.%d" % (rnd.randint(0, 255),
+        rnd.randint(0, 255), rnd.randint(0, 255)), u"SessionId": u"%032X" % rnd.getrandbits(128),
+        u"StartTime": 1464739200000 + rnd.randint(0, 10 ** 9), u"Roles": [u"admin", u"readonly"],
+        u"Secure": rnd.random() < 0.5}) for i in range(count))
+
+
+def load(path, name):
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name, path)
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+    except ImportError:
+        import imp
+        mod = imp.load_source(name, path)
+    return mod
+
+
+def check(javaser, corpus):
+    bad = 0
+    for values in corpus:
+        got = [plain(v) for v in javaser.loads(dumps(*values))]
+        if got != values:
+            bad += 1
+            if bad <= 3:
+                print("  MISMATCH\n    wrote   %r\n    decoded %r" % (values, got))
+    print("roundtrip: %d streams, %d mismatched" % (len(corpus), bad))
+    return bad
+
+
+def fuzz(javaser, corpus, count, seed=3):
+    rnd = random.Random(seed)
+    streams = [bytearray(dumps(*values)) for values in corpus]
+    errors, failures = 0, 0
+    for i in range(count):
+        data = bytearray(rnd.choice(streams))
+        for j in range(rnd.randint(1, 4)):
+            what, at = rnd.randint(0, 2), rnd.randint(0, len(data))
+            if what == 0 and at < len(data):
+                data[at] = rnd.getrandbits(8)
+            elif what == 1:
+                data[at:at] = bytearray(rnd.getrandbits(8) for k in range(rnd.randint(1, 4)))
+            else:
+                del data[at:]
+        try:
+            javaser.loads(bytes(data))
+        except javaser.JavaSerError:
+            errors += 1
+        except Exception:
+            failures += 1
+            if failures <= 3:
+                print("  FAILED on %r" % bytes(data))
+                traceback.print_exc()
+    print("fuzz: %d damaged streams, %d JavaSerError, %d other exceptions" % (count, errors, failures))
+    return failures
+
+
+def main(args):
+    modules = [(m, load(m, "javaser_%d" % n)) for n, m in enumerate(args.module or [os.path.join(HERE, "javaser.py")])]
+    corpus = make_corpus(args.corpus)
+    failed = 0
+    for path, javaser in modules:
+        print(path)
+        failed += check(javaser, corpus)
+        if args.fuzz:
+            failed += fuzz(javaser, corpus, args.fuzz)
+
+    print("\n%8s  %10s  %10s  %10s  %10s  %s" % ("entries", "bytes", "seconds", "MB/s", "objects/s", "module"))
+    for count in args.counts:
+        data = dumps(make_sessions(count))
+        objects = count * 7             # per entry: its HashMap, 3 values, key, the Long, the ArrayList
+        for path, javaser in modules:
+            best = None
+            for i in range(args.repeat):
+                t0 = time.time()
+                javaser.loads(data)
+                secs = time.time() - t0
+                best = secs if best is None or secs < best else best
+            print("%8d  %10d  %10.3f  %10.1f  %10d  %s" % (count, len(data), best,
+                len(data) / best / 1024 ** 2, objects / best, path))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="check and benchmark javaser.py")
+    ap.add_argument("-n", "--counts", type=int, nargs="*", default=[1000, 10000, 100000],
+        help="HashMap sizes to time (default: 1000 10000 100000)")
+    ap.add_argument("-r", "--repeat", type=int, default=3, help="runs per measurement, best is kept (default: 3)")
+    ap.add_argument("-c", "--corpus", type=int, default=500, help="random streams to roundtrip (default: 500)")
+    ap.add_argument("--fuzz", type=int, default=0, help="damaged streams to decode (default: none)")
+    ap.add_argument("--module", action="append",
+        help="javaser.py to check and time, can be repeated (default: the one next to this)")
+    args = ap.parse_args()
+    main(args)
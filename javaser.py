@@ -0,0 +1,379 @@
+# Decoder for Java serialization streams, what java.io.ObjectOutputStream
+# writes and CPS keeps in memcached (see cc-sessions.py). Works with python2
+# and python3.
+#
+#   objs = javaser.loads(data)
+#
+# gives the objects in the stream, in order:
+#   String               unicode string
+#   primitive array      bytes for byte[], a list for the rest
+#   Object[], ...        list
+#   enum constant        {"_cls": JavaClass, "_name": constant name}
+#   Class                its JavaClass
+#   anything else        {"_cls": JavaClass, "_name": short class name,
+#                         field name: value, ...}
+# and for the common java.util collections, "data" in that dict holds the
+# contents: a dict for the maps (a list of (key, value) if a key can't be a
+# python dict key), a list for the lists, sets and queues. Classes with a
+# writeObject() not known here get what it wrote in "_annotations".
+#
+# The stream is read in place by offset, not through a file object: type
+# codes are indexed out of it, the rest unpacked from a memoryview of it with
+# struct.unpack_from, the primitive fields of a class with the one
+# struct.Struct made when its descriptor is first seen.
+#
+# Spec: https://docs.oracle.com/javase/8/docs/platform/serialization/spec/protocol.html
+
+# Not official Cisco software.
+
+import codecs
+import struct
+
+STREAM_MAGIC = 0xACED
+STREAM_VERSION = 5
+BASE_WIRE_HANDLE = 0x7E0000
+
+TC_NULL = 0x70
+TC_REFERENCE = 0x71
+TC_CLASSDESC = 0x72
+TC_OBJECT = 0x73
+TC_STRING = 0x74
+TC_ARRAY = 0x75
+TC_CLASS = 0x76
+TC_BLOCKDATA = 0x77
+TC_ENDBLOCKDATA = 0x78
+TC_RESET = 0x79
+TC_BLOCKDATALONG = 0x7A
+TC_EXCEPTION = 0x7B
+TC_LONGSTRING = 0x7C
+TC_PROXYCLASSDESC = 0x7D
+TC_ENUM = 0x7E
+
+SC_WRITE_METHOD = 0x01
+SC_SERIALIZABLE = 0x02
+SC_EXTERNALIZABLE = 0x04
+SC_BLOCK_DATA = 0x08
+SC_ENUM = 0x10
+
+# field type code: struct format
+PRIMITIVES = {"B": "b", "C": "H", "D": "d", "F": "f", "I": "i", "J": "q", "S": "h", "Z": "?"}
+
+u8 = struct.Struct(">B")
+u16 = struct.Struct(">H")
+i32 = struct.Struct(">i")
+u32 = struct.Struct(">I")
+i64 = struct.Struct(">q")
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+try:
+    codecs.lookup_error("surrogatepass")
+    SURROGATES = "surrogatepass"
+except LookupError:
+    SURROGATES = "strict"               # python2 lets them through anyway
+LAX_UTF8 = SURROGATES == "strict"
+
+
+class JavaSerError(ValueError):
+    pass
+
+
+class JavaClass(object):
+    # A class descriptor. prim unpacks all the primitive field values of an
+    # object of this class (they come first, in the order of the fields,
+    # which puts them first), objects are the names of the rest.
+    __slots__ = ("name", "short_name", "suid", "flags", "fields", "parent", "prim", "prim_names", "objects",
+        "chars", "chain")
+
+    def __init__(self, name, suid, flags, fields):
+        self.name, self.suid, self.flags, self.fields = name, suid, flags, fields
+        self.short_name = name.split(".")[-1]
+        self.parent, self.chain = None, None
+        prim = [(f, PRIMITIVES[t]) for f, t, c in fields if t in PRIMITIVES]
+        self.prim = struct.Struct(">" + "".join(p for f, p in prim))
+        self.prim_names = tuple(f for f, p in prim)
+        self.objects = tuple(f for f, t, c in fields if t not in PRIMITIVES)
+        self.chars = tuple(f for f, t, c in fields if t == "C")
+
+    def hierarchy(self):
+        # superclass first, as the field values come
+        if self.chain is None:
+            classes = []
+            cls = self
+            while cls is not None:
+                if cls in classes:
+                    raise JavaSerError("%r is its own superclass" % cls)
+                classes.append(cls)
+                cls = cls.parent
+            self.chain = classes[::-1]
+        return self.chain
+
+    def __repr__(self):
+        name = self.name
+        if not isinstance(name, str):
+            name = name.encode("utf-8")   # python2
+        return "<JavaClass %s>" % name
+
+
+def _map(pairs):
+    try:
+        return dict(pairs)
+    except TypeError:
+        return pairs                    # unhashable keys
+
+
+def _pairs(objs):
+    return list(zip(objs[0::2], objs[1::2]))
+
+# What the writeObject() of these collections writes after their fields is a
+# count or two as block data then the contents, so given the objects of the
+# annotation, their contents are:
+COLLECTIONS = {
+    "java.util.HashMap": lambda objs: _map(_pairs(objs)),
+    "java.util.Hashtable": lambda objs: _map(_pairs(objs)),
+    "java.util.TreeMap": lambda objs: _map(_pairs(objs)),
+    "java.util.IdentityHashMap": lambda objs: _map(_pairs(objs)),
+    "java.util.concurrent.ConcurrentHashMap": lambda objs: _map(_pairs(objs[:-2])),    # ends with null, null
+    "java.util.HashSet": list,
+    "java.util.TreeSet": lambda objs: objs[1:],      # after the comparator
+    "java.util.ArrayList": list,
+    "java.util.LinkedList": list,
+    "java.util.ArrayDeque": list,
+    "java.util.PriorityQueue": list,
+    "java.util.concurrent.CopyOnWriteArrayList": list,
+}
+
+
+class Decoder(object):
+    def __init__(self, data):
+        # data to index a type code out of, buf a view of it for everything
+        # else
+        self.data = data if isinstance(data, bytearray) else bytearray(data)
+        self.buf = memoryview(self.data)
+        self.size = len(self.data)
+        self.pos = 0
+        self.handles = []
+
+    def take(self, n):
+        pos = self.pos
+        if n < 0 or pos + n > self.size:
+            raise JavaSerError("truncated at offset %d, wanted %d bytes" % (pos, n))
+        self.pos = pos + n
+        return self.buf[pos:pos + n]
+
+    def unpack(self, st):
+        v = st.unpack_from(self.buf, self.pos)
+        self.pos += st.size
+        return v
+
+    def byte(self):
+        v = u8.unpack_from(self.buf, self.pos)[0]
+        self.pos += 1
+        return v
+
+    def utf(self, n):
+        pos = self.pos
+        if n < 0 or pos + n > self.size:
+            raise JavaSerError("truncated at offset %d, wanted %d bytes" % (pos, n))
+        self.pos = pos + n
+        b = self.data[pos:pos + n]
+        try:
+            if not (LAX_UTF8 and b"\xed" in b):
+                return b.decode("utf-8")
+        except UnicodeDecodeError:
+            pass
+        # modified UTF-8: NUL as two bytes, and past U+FFFF each half of the
+        # surrogate pair encoded on its own
+        b = bytes(b.replace(b"\xc0\x80", b"\0"))
+        try:
+            return b.decode("utf-8", SURROGATES).encode("utf-16-be", SURROGATES).decode("utf-16-be")
+        except UnicodeError:
+            return b.decode("utf-8", "replace")
+
+    def new_handle(self, obj):
+        self.handles.append(obj)
+        return len(self.handles) - 1
+
+    def stream(self):
+        magic, version = self.unpack(struct.Struct(">HH"))
+        if magic != STREAM_MAGIC or version != STREAM_VERSION:
+            raise JavaSerError("not a Java serialization stream (%04x %d)" % (magic, version))
+        objs = []
+        while self.pos < self.size:
+            tc = self.data[self.pos]
+            if tc in (TC_BLOCKDATA, TC_BLOCKDATALONG):
+                self.pos += 1
+                objs.append(self.block(tc).tobytes())
+            else:
+                objs.append(self.content())
+        return objs
+
+    def block(self, tc):
+        n = self.byte() if tc == TC_BLOCKDATA else self.unpack(i32)[0]
+        return self.take(n)
+
+    def content(self):
+        # the most common first, and those without a method call each
+        pos = self.pos
+        tc = self.data[pos]
+        if tc == TC_STRING:
+            self.pos = pos + 3
+            s = self.utf(u16.unpack_from(self.buf, pos + 1)[0])
+            self.handles.append(s)
+            return s
+        if tc == TC_REFERENCE:
+            self.pos = pos + 5
+            h = u32.unpack_from(self.buf, pos + 1)[0] - BASE_WIRE_HANDLE
+            if not 0 <= h < len(self.handles):
+                raise JavaSerError("bad handle %x at offset %d" % (h + BASE_WIRE_HANDLE, pos + 1))
+            return self.handles[h]
+        self.pos = pos + 1
+        if tc == TC_OBJECT:
+            return self.object()
+        if tc == TC_NULL:
+            return None
+        if tc == TC_ARRAY:
+            return self.array()
+        if tc in (TC_CLASSDESC, TC_PROXYCLASSDESC):
+            return self.classdesc(tc)
+        if tc == TC_CLASS:
+            cls = self.content()
+            self.handles.append(cls)
+            return cls
+        if tc == TC_ENUM:
+            enum = {"_cls": self.content()}
+            self.handles.append(enum)
+            enum["_name"] = self.content()
+            return enum
+        if tc == TC_LONGSTRING:
+            s = self.utf(self.unpack(i64)[0])
+            self.handles.append(s)
+            return s
+        if tc == TC_RESET:
+            self.handles = []
+            return self.content()
+        if tc == TC_EXCEPTION:
+            raise JavaSerError("stream holds an exception written while serializing")
+        raise JavaSerError("unknown type code %02x at offset %d" % (tc, self.pos - 1))
+
+    def classdesc(self, tc):
+        if tc == TC_PROXYCLASSDESC:
+            cls = JavaClass("$Proxy", 0, SC_SERIALIZABLE, [])
+            self.new_handle(cls)
+            count = self.unpack(i32)[0]
+            if count > self.size - self.pos:
+                raise JavaSerError("proxy class with %d interfaces" % count)
+            for i in range(count):
+                self.utf(self.unpack(u16)[0])
+        else:
+            name = self.utf(self.unpack(u16)[0])
+            suid, flags = self.unpack(struct.Struct(">qB"))
+            h = self.new_handle(None)
+            fields = []
+            for i in range(self.unpack(u16)[0]):
+                typ = chr(self.byte())
+                fname = self.utf(self.unpack(u16)[0])
+                if typ in "L[":
+                    fcls = self.content()
+                elif typ in PRIMITIVES:
+                    fcls = None
+                else:
+                    raise JavaSerError("unknown field type %r for %s.%s" % (typ, name, fname))
+                fields.append((fname, typ, fcls))
+            cls = JavaClass(name, suid, flags, fields)
+            self.handles[h] = cls
+        self.annotation()               # class annotation, unused
+        cls.parent = self.content()
+        if cls.parent is not None and not isinstance(cls.parent, JavaClass):
+            raise JavaSerError("superclass of %s isn't a class" % cls.name)
+        return cls
+
+    def annotation(self):
+        # block data and objects up to TC_ENDBLOCKDATA
+        blocks, objs = [], []
+        data = self.data
+        while True:
+            tc = data[self.pos]
+            if tc == TC_ENDBLOCKDATA:
+                self.pos += 1
+                return blocks, objs
+            if tc in (TC_BLOCKDATA, TC_BLOCKDATALONG):
+                self.pos += 1
+                blocks.append(self.block(tc).tobytes())
+            else:
+                objs.append(self.content())
+
+    def array(self):
+        cls = self.content()
+        if not isinstance(cls, JavaClass) or not cls.name.startswith("["):
+            raise JavaSerError("array of %r" % (cls,))
+        size = self.unpack(i32)[0]
+        if size < 0:
+            raise JavaSerError("array of %d elements" % size)
+        typ = cls.name[1]
+        if typ == "B":
+            data = self.take(size).tobytes()
+        elif typ in PRIMITIVES:
+            st = struct.Struct(">%d%s" % (size, PRIMITIVES[typ]))
+            if self.pos + st.size > self.size:
+                raise JavaSerError("truncated %s[%d]" % (cls.name, size))
+            data = list(self.unpack(st))
+            if typ == "C":
+                data = [unichr(c) for c in data]
+        else:
+            if size > self.size - self.pos:
+                raise JavaSerError("truncated %s[%d]" % (cls.name, size))
+            data = []
+            self.handles.append(data)
+            for i in range(size):
+                data.append(self.content())
+            return data
+        self.handles.append(data)
+        return data
+
+    def object(self):
+        cls = self.content()
+        if not isinstance(cls, JavaClass):
+            raise JavaSerError("object of %r" % (cls,))
+        obj = {"_cls": cls, "_name": cls.short_name}
+        self.handles.append(obj)
+        for c in cls.chain or cls.hierarchy():
+            flags = c.flags
+            if flags & SC_SERIALIZABLE:
+                if c.prim_names:
+                    pos = self.pos
+                    self.pos = pos + c.prim.size
+                    obj.update(zip(c.prim_names, c.prim.unpack_from(self.buf, pos)))
+                    for f in c.chars:
+                        obj[f] = unichr(obj[f])
+                for f in c.objects:
+                    obj[f] = self.content()
+                if flags & SC_WRITE_METHOD:
+                    blocks, objs = self.annotation()
+                    if c.name in COLLECTIONS:
+                        obj["data"] = COLLECTIONS[c.name](objs)
+                    else:
+                        obj["_annotations"] = (blocks, objs)
+            elif flags & SC_EXTERNALIZABLE:
+                if not flags & SC_BLOCK_DATA:
+                    raise JavaSerError("%s uses the old externalizable protocol" % c.name)
+                obj["_annotations"] = self.annotation()
+            else:
+                raise JavaSerError("%s has class flags %02x" % (c.name, flags))
+        if cls.name in ("java.util.Vector", "java.util.Stack") and isinstance(obj.get("elementData"), list):
+            obj["data"] = obj["elementData"][:obj.get("elementCount", 0)]
+        return obj
+
+
+def loads(data):
+    # the objects in data, a Java serialization stream; JavaSerError for
+    # anything it can't make sense of
+    try:
+        return Decoder(data).stream()
+    except (struct.error, IndexError) as e:
+        raise JavaSerError("truncated stream: %s" % e)
+    except RuntimeError as e:
+        raise JavaSerError("objects nested too deep: %s" % e)
@@ -8,18 +8,49 @@
 # Copyright: 2026 Cisco, Inc
 
 import argparse
+import asyncio
+import concurrent.futures
 import datetime as DT
+import functools
+import itertools
 import gzip
+import hashlib
+import http.client
+import io
+import json
+import math
+import multiprocessing
 import os
 import re
+import signal
 import stat
+import statistics
 import sys
+import threading
+import time
+import urllib.parse
+from array import array
+
+STATE_VERSION = 2
+STATE_HEAD_BYTES = 4096
+TAIL_CHUNK = 1024 * 1024
+PROM_QUERY = 'peer_connection_status{{remote_peer="{peer}"}}'
+PROM_MAX_POINTS = 11000     # prometheus refuses a query_range longer than this
+PROM_MARGIN = 60            # seconds either side of an outage
 
 class alertInstance:
+    # There can be millions of these (peer flaps), so they're slotted, the
+    # component and notification names are interned, and all_attributes
+    # (every varbind of the trap) is only kept when asked for: repr() needs
+    # it, which is --raw and -v. Otherwise it's None.
+    __slots__ = ("date", "name", "status", "snmptype", "all_attributes")
+
     pattern = r'\S+::([^\s.=]+(?:\.\d+)?)\s*=\s*\S+:\s*(.*?)(?=\s+\S+::|$)'
 
-    date, name, status, snmptype = None, None, None, None
-    all_attributes = None
+    # the attributes anything here looks at, all that compact() keeps
+    compact_attributes = ("broadhopComponentNotificationName", "broadhopComponentName",
+        "broadhopComponentTime", "broadhopNotificationFacility", "broadhopNotificationSeverity",
+        "broadhopComponentAdditionalInfo")
 
     # ARRRRRRRRRG they switch month and day. It's SO close to ISO time!
     def parse_broadhop_time(self, s: str):
@@ -33,6 +64,9 @@ class alertInstance:
 
     def __repr__(self):
         dt = self.date.isoformat().replace("+00:00", "").replace("T", " ")
+        if self.all_attributes is None:
+            # carried over by --state, there's nothing more to show
+            return f"{dt} | {self.snmptype} | {self.name}"
         name = self.all_attributes["broadhopComponentNotificationName"]
         facility = self.all_attributes["broadhopNotificationFacility"]
         severity = self.all_attributes["broadhopNotificationSeverity"]
@@ -40,7 +74,8 @@ class alertInstance:
 
         return f"{dt} | {name} | Fac={facility} | Sev={severity} | {info}"
 
-    def __init__(self, line: str):
+    def __init__(self, line: str, keep_attributes=True):
+        self.date, self.name, self.status, self.all_attributes = None, None, None, None
         try:
             matches = re.findall(self.pattern, line)
         except:
@@ -48,7 +83,7 @@ class alertInstance:
             sys.exit(1)
         result = { k.split('.')[0]: v.strip() for k, v in matches}
 
-        self.snmptype = result["broadhopComponentNotificationName"]
+        self.snmptype = sys.intern(result["broadhopComponentNotificationName"])
 
         if "broadhopComponentTime" in result:
             self.date = self.parse_broadhop_time(result["broadhopComponentTime"])
@@ -60,6 +95,7 @@ class alertInstance:
             self.name = result["broadhopComponentName"]
             if "/" in self.name:
                 self.name = self.name[self.name.index("/")+1:]
+            self.name = sys.intern(self.name)
             result["broadhopComponentName"] = self.name
         else:
             print("NO PEER", line)
@@ -80,10 +116,63 @@ class alertInstance:
 #            print(k, v)
 #            
 #        sys.exit(1)
-        self.all_attributes = result
+        if keep_attributes:
+            self.all_attributes = result
 
         # print(result)
 
+    def compact(self):
+        # a tuple to send back from a -j worker instead of the whole object
+        values = None
+        if self.all_attributes is not None:
+            values = tuple(self.all_attributes.get(k) for k in self.compact_attributes)
+        return (self.date, self.name, self.status, self.snmptype, values)
+
+    @classmethod
+    def from_compact(cls, t):
+        a = cls.__new__(cls)
+        a.date, a.name, a.status, a.snmptype, values = t
+        # pickling loses the interning
+        if a.name is not None:
+            a.name = sys.intern(a.name)
+        a.snmptype = sys.intern(a.snmptype)
+        a.all_attributes = None
+        if values is not None:
+            a.all_attributes = { k: v for k, v in zip(cls.compact_attributes, values) if v is not None }
+        return a
+
+class trapFilter:
+    # Decides from a couple of cheap searches, before alertInstance runs the
+    # full varbind regex, whether a trap matters: only the --name traps do,
+    # less the components an --ignore pattern throws out (not for --raw,
+    # which shows them all). Every trap's notification name is counted on
+    # the way, which is all --list needs.
+    name_re = re.compile(r'::broadhopComponentNotificationName(?:\.\d+)?\s*=\s*\S+:\s*(.*?)(?=\s+\S+::|$)')
+    component_re = re.compile(r'::broadhopComponentName(?:\.\d+)?\s*=\s*\S+:\s*(.*?)(?=\s+\S+::|$)')
+
+    def __init__(self, args):
+        self.name = args.name
+        self.parse = not args.list
+        self.keep_attributes = args.raw or args.verbose
+        self.ignore = [] if args.raw else ignore_expressions(args)
+
+    def wanted(self, line, counts):
+        m = self.name_re.search(line)
+        if not m:
+            return True         # leave it to alertInstance to complain about
+        name = m.group(1).strip()
+        counts[name] = counts.get(name, 0) + 1
+        if not self.parse or name != self.name:
+            return False
+        m = self.component_re.search(line)
+        if m and self.ignore:
+            component = m.group(1).strip()
+            if "/" in component:
+                component = component[component.index("/")+1:]
+            if skipp(self.ignore, component):
+                return False
+        return True
+
 class alertMap:
     alerts_map = {}
 
@@ -97,12 +186,10 @@ class alertMap:
         self.first = first
         self.last = last
         
-    def show_resolved_alerts(self, args):
-
-        count = 0
-
+    def resolved_alerts(self, args):
+        # (component, prev, alert, delta) for every clear, paired with the
+        # alert before it, that passes the -l/-m/-o limits
         for k, v in self.alerts_map.items():
-            flag = False
             for i in range(1, len(v)):
                 alert = v[i]
                 prev = v[i-1]
@@ -110,23 +197,70 @@ class alertMap:
                 if alert.status == True:
                     delta = alert.date - prev.date
                     if not args.least or check_time_args(args, delta.seconds):
-                        count += 1
-                        if flag == False:
-                            if not args.script:
-                                print("Component Name:", k)
-                            else:
-                                script_fd.write(f"echo 'Component Name: {k}' >> $OUTFILE\n\n")
-                            flag = True
-                        if not args.script:
-                            print(f"    Duration: {delta.total_seconds():10} sec  {prev} {alert}")
-                        else:
-                            msg = f"echo '{alert.date}: {delta.seconds:5} sec  {prev} {alert}' >> $OUTFILE"
-                            command = f'curl -G "http://localhost:9090/api/v1/query_range" --data-urlencode \'query=peer_connection_status{{remote_peer="{k}"}}\' --data-urlencode "start={prev.zulu_delta(-60)}" --data-urlencode "end={alert.zulu_delta(60)}" --data-urlencode "step=1s" | python -m json.tool >> $OUTFILE'
-                            script_fd.write(f"{msg}\n")
-                            script_fd.write(f"{command}\n\n")
+                        yield k, prev, alert, delta
+
+    def show_resolved_alerts(self, args):
+
+        count = 0
+
+        for k, pairs in itertools.groupby(self.resolved_alerts(args), key=lambda r: r[0]):
+            if not args.script:
+                print("Component Name:", k)
+            else:
+                self.script_fd.write(f"echo 'Component Name: {k}' >> $OUTFILE\n\n")
+            for k, prev, alert, delta in pairs:
+                count += 1
+                if not args.script:
+                    print(f"    Duration: {delta.total_seconds():10} sec  {prev} {alert}")
+                else:
+                    msg = f"echo '{alert.date}: {delta.seconds:5} sec  {prev} {alert}' >> $OUTFILE"
+                    command = f'curl -G "http://localhost:9090/api/v1/query_range" --data-urlencode \'query=peer_connection_status{{remote_peer="{k}"}}\' --data-urlencode "start={prev.zulu_delta(-60)}" --data-urlencode "end={alert.zulu_delta(60)}" --data-urlencode "step=1s" | python -m json.tool >> $OUTFILE'
+                    self.script_fd.write(f"{msg}\n")
+                    self.script_fd.write(f"{command}\n\n")
 
         return count
 
+    def aggregate_resolved_alerts(self, args):
+        # --aggregate: instead of a line per outage, per component and per
+        # time bucket (by when the outage started) the outage count,
+        # min/median/p99 duration and total downtime. The pairs go into two
+        # columns per component first, outage start and duration, so each
+        # bucket is a slice of them. A bucket with more than --flap-rate
+        # outages an hour marks the component as flapping.
+        width = args.aggregate
+        columns = {}
+        for k, prev, alert, delta in self.resolved_alerts(args):
+            if k not in columns:
+                columns[k] = (array("d"), array("d"))
+            starts, durations = columns[k]
+            starts.append(prev.date.timestamp())
+            durations.append(delta.total_seconds())
+
+        count, flapping = 0, []
+        max_flaps = args.flap_rate * width / 3600
+        for k, (starts, durations) in columns.items():
+            print("Component Name:", k)
+            count += len(starts)
+            flag = False
+            pos = 0
+            for bucket, run in itertools.groupby(starts, key=lambda t: int(t // width)):
+                n = len(list(run))
+                d = sorted(durations[pos:pos+n])
+                pos += n
+                p99 = d[max(math.ceil(0.99 * n) - 1, 0)]
+                when = DT.datetime.fromtimestamp(bucket * width, DT.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+                mark = ""
+                if n > max_flaps:
+                    mark, flag = "  FLAPPING", True
+                print(f"    {when}  outages: {n:5}  min: {d[0]:8.1f}  median: {statistics.median(d):8.1f}  p99: {p99:8.1f}  down: {sum(d):10.1f} sec{mark}")
+            if flag:
+                flapping.append(k)
+
+        print(f"  Flapping components (over {args.flap_rate:g} outages/hour): {len(flapping)}")
+        for k in flapping:
+            print(f"    {k}")
+        return count
+
     def show_unresolved_alerts(self, args):
         count = 0
         for k, v in self.alerts_map.items():
@@ -153,21 +287,27 @@ class alertMap:
                 
         return count
 
-def mk_alert_map(args, alerts):
+def mk_alert_map(args, alerts, carried=()):
     alerts_map = {}
 
     first_date, last_date, count = None, None, 0
 
-    ignore_expressions = [ re.compile("^sigm") ]
-    if args.ignore:
-        for r in args.ignore:
-            ignore_expressions.append(re.compile(r))
+    ignore = ignore_expressions(args)
+
+    # the open alerts from an earlier run (--state): in the map so new clears
+    # pair up with them, but already counted back then
+    for a in carried:
+        alerts_map.setdefault(a.name, []).append(a)
+        if not first_date or a.date < first_date:
+            first_date = a.date
+        if not last_date or a.date > last_date:
+            last_date = a.date
 
     for a in alerts:
         if a.snmptype != args.name:
             continue
 
-        if skipp(ignore_expressions, a.name):
+        if skipp(ignore, a.name):
             continue
 
         if args.verbose:
@@ -193,6 +333,13 @@ def mk_alert_map(args, alerts):
     am_obj.count = count
     return am_obj
 
+def ignore_expressions(args):
+    ignore = [ re.compile("^sigm") ]
+    if args.ignore:
+        for r in args.ignore:
+            ignore.append(re.compile(r))
+    return ignore
+
 def check_time_args(args, secs):
     if args.least and not args.max:
         ret_value = True if secs >= args.least else False
@@ -217,37 +364,195 @@ def skipp(ignore, k):
 
     return True if flag_skip else False
 
-def list_alerts_present(args, alerts):
-    notifications = {}
-    length = -1
-
-    for a in alerts:
-        name = a.all_attributes["broadhopComponentNotificationName"]
-        if len(name) > length:
-            length = len(name)
+def list_alerts_present(args, notifications):
+    length = max([len(name) for name in notifications] + [-1])
 
-        if name in notifications:
-            notifications[name] += 1
-        else:
-            notifications[name] = 1
     for n in sorted(notifications.keys()):
         print("  ", n.ljust(length), notifications[n])
     print("# alert types:", len(notifications))
 
 
-def read_alerts(args):
-    alerts = []
-
-    for fn in args.trapfiles:
-        openf = gzip.open if fn.endswith(".gz") else open
-        fd = openf(fn, mode="rt", encoding="utf-8")
-        for line in fd:
-            if "BROADHOP-MIB" not in line:
-                continue
-            alerts.append(alertInstance(line))
+def state_key(head):
+    # what --state knows a trap file by: the length and sha1 of its first
+    # STATE_HEAD_BYTES (all of it while it's shorter). That stays the same
+    # when it's rotated and compressed, and tells a new file apart from the
+    # old one even when both start with the same snmptrapd banner.
+    return "%d:%s" % (len(head), hashlib.sha1(head).hexdigest())
+
+def saved_offset(head, seen):
+    # the offset --state has for the file starting with head. It may have
+    # been shorter than STATE_HEAD_BYTES last time, so shorter heads that
+    # were saved are tried as well.
+    for n in sorted(set(int(k.split(":")[0]) for k in seen), reverse=True):
+        if 0 < n <= len(head) and state_key(head[:n]) in seen:
+            return seen[state_key(head[:n])]
+    return 0
+
+def read_trapfile(fn, trap_filter, seen=None):
+    # Returns ({notification name: count}, [alertInstance, ...], key, offset,
+    # complete), the alerts being the traps trap_filter wants. key is the
+    # state_key() of the file and offset is how far into the (uncompressed)
+    # file we got. With seen, the {key: offset} from --state, reading starts
+    # where the last run stopped and a partial last line is left for next
+    # time; complete is False if that happened. A file shorter than its saved
+    # offset is a new one and is read from the start. Without seen, the file
+    # is only read forward, so pipes work.
+    counts, alerts, complete = {}, [], True
+    openf = gzip.open if fn.endswith(".gz") else open
+    fd = openf(fn, mode="rb")
+    key, offset, pending = None, 0, b""
+    if seen is not None:
+        head = fd.read(STATE_HEAD_BYTES)
+        key = state_key(head) if head else None
+        offset = saved_offset(head, seen) if head else 0
+        if offset and fd.seekable():
+            if not fn.endswith(".gz") and os.fstat(fd.fileno()).st_size < offset:
+                offset = 0
+            fd.seek(offset)
+            if fd.tell() < offset:
+                offset = 0
+                fd.seek(0)
+        elif offset > len(head):
+            # a pipe: what the last run read is skipped by reading past it
+            skip = offset - len(head)
+            while skip > 0:
+                block = fd.read(min(skip, TAIL_CHUNK))
+                if not block:
+                    break
+                skip -= len(block)
+        else:
+            pending = head[offset:]
+    lines = fd
+    if pending:
+        lines = itertools.chain(io.BytesIO(pending + fd.readline()), fd)
+    for line in lines:
+        if seen is not None and not line.endswith(b"\n"):
+            complete = False
+            break
+        offset += len(line)
+        if b"BROADHOP-MIB" not in line:
+            continue
+        line = line.decode("utf-8")
+        if trap_filter.wanted(line, counts):
+            alerts.append(alertInstance(line, trap_filter.keep_attributes))
+    fd.close()
+    return counts, alerts, key, offset, complete
+
+def parse_trapfile(fn, trap_filter, seen=None):
+    # -j worker. None if a trap was bad enough for alertInstance to exit on,
+    # which would otherwise just take the worker down
+    try:
+        counts, alerts, key, offset, complete = read_trapfile(fn, trap_filter, seen)
+        return counts, [a.compact() for a in alerts], key, offset, complete
+    except SystemExit:
+        return None
+
+def read_alerts(args, state=None):
+    # returns ({notification name: count} over all the traps, [alertInstance, ...],
+    # {file key: offset}, {compressed file: [size, mtime]}); with --state only
+    # what's new since the last run is read. Compressed files don't grow, so
+    # one the last run read to the end and that has the same size and mtime is
+    # skipped without opening it, rather than inflated again up to its offset.
+    notifications, alerts, files, compressed = {}, [], {}, {}
+    trap_filter = trapFilter(args)
+    seen = None
+    trapfiles = args.trapfiles
+    if args.state:
+        seen = state["files"] if state else {}
+        done = state.get("compressed", {}) if state else {}
+        trapfiles = []
+        for fn in args.trapfiles:
+            if fn.endswith(".gz"):
+                st = os.stat(fn)
+                compressed[fn] = [st.st_size, st.st_mtime_ns]
+                if done.get(fn) == compressed[fn]:
+                    continue
+            trapfiles.append(fn)
+
+    if args.jobs > 1 and len(trapfiles) > 1:
+        with multiprocessing.Pool(min(args.jobs, len(trapfiles))) as pool:
+            parsed = pool.map(functools.partial(parse_trapfile, trap_filter=trap_filter, seen=seen),
+                trapfiles)
+            pool.close()
+            pool.join()
+        if None in parsed:
+            sys.exit(1)
+        results = [(counts, [alertInstance.from_compact(t) for t in compacted], key, offset, complete)
+            for counts, compacted, key, offset, complete in parsed]
+    else:
+        results = [read_trapfile(fn, trap_filter, seen) for fn in trapfiles]
+
+    for fn, (counts, file_alerts, key, offset, complete) in zip(trapfiles, results):
+        for name, n in counts.items():
+            notifications[name] = notifications.get(name, 0) + n
+        alerts.extend(file_alerts)
+        if key:
+            files[key] = max(offset, files.get(key, 0))
+        if not (complete and key):
+            compressed.pop(fn, None)
     
-    print("# Alerts parsed:", len(alerts))
-    return alerts
+    print("# Alerts parsed:", sum(notifications.values()))
+    return notifications, alerts, files, compressed
+
+def load_state(args):
+    # --state: what the last run left behind, or None to start from scratch
+    try:
+        with open(args.state) as fd:
+            state = json.load(fd)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"{args.state}: unusable ({e}), starting over")
+        return None
+    if state.get("version") != STATE_VERSION:
+        print(f"{args.state}: from an older version of this script, starting over")
+        return None
+    if state.get("name") != args.name or state.get("ignore") != (args.ignore or []):
+        print(f"{args.state}: from a run with a different --name or --ignore, starting over")
+        return None
+    return state
+
+def carried_alerts(state):
+    # the alerts the last run left open, as alertInstances again
+    carried = []
+    for k, v in state["components"].items():
+        for date, status in v:
+            carried.append(alertInstance.from_compact(
+                (DT.datetime.fromisoformat(date), k, status, state["name"], None)))
+    return carried
+
+def save_state(args, state, alert_map, notifications, files, compressed, resolved):
+    # For each component we keep what a later clear could pair with or the
+    # unresolved report needs: its trailing run of downs, or else its last
+    # alert. Counts are carried forward so the report totals cover
+    # everything seen, not just this run.
+    components = {}
+    for k, v in alert_map.alerts_map.items():
+        i = len(v)
+        while i > 0 and v[i-1].status == False:
+            i -= 1
+        tail = v[i:] if i < len(v) else v[-1:]
+        components[k] = [[a.date.isoformat(), a.status] for a in tail]
+
+    if state:
+        # files not given this time may be again, rotated
+        for key, offset in state["files"].items():
+            files.setdefault(key, offset)
+    new_state = {
+        "version": STATE_VERSION,
+        "name": args.name,
+        "ignore": args.ignore or [],
+        "files": files,
+        "compressed": compressed,
+        "notifications": notifications,
+        "count": alert_map.count,
+        "resolved": resolved,
+        "components": components,
+    }
+    tmp = args.state + ".tmp"
+    with open(tmp, "w") as fd:
+        json.dump(new_state, fd)
+    os.replace(tmp, args.state)
      
 def initial_script(args):
     try:
@@ -268,9 +573,315 @@ OUTFILE="/tmp/curl-report-$1.txt"
 """)
     return script_fd
 
+class liveState:
+    # -f: the up/down state of every (notification name, component), kept up
+    # to date as traps come in. Resolved alerts pair a clear with the alert
+    # before it for the same component, as show_resolved_alerts() does, and
+    # are listed for --name only; the open alerts and counters cover every
+    # notification type.
+    def __init__(self, args):
+        self.args = args
+        self.ignore = ignore_expressions(args)
+        self.last = {}          # key -> last alert
+        self.fired = {}         # key -> [first down of the open run, downs in it]
+        self.resolved = []      # (key, prev, alert, delta) since the last report
+        self.traps = 0
+        self.report_time, self.report_traps = time.time(), 0
+
+    def feed(self, line):
+        if "BROADHOP-MIB" not in line:
+            return
+        try:
+            a = alertInstance(line, False)
+        except SystemExit:
+            return              # alertInstance has said what was wrong with it
+        except (KeyError, ValueError) as e:
+            # a missing varbind or a time that doesn't parse; one bad trap
+            # mustn't stop the file from being followed
+            print(f"Skipping bad trap ({e!r}): {line.rstrip()}")
+            return
+        if a.date is None or a.name is None or skipp(self.ignore, a.name):
+            return
+        self.traps += 1
+        key = (a.snmptype, a.name)
+        prev = self.last.get(key)
+        self.last[key] = a
+        if a.status == False:
+            if key in self.fired:
+                self.fired[key][1] += 1
+            else:
+                self.fired[key] = [a, 1]
+        elif a.status == True:
+            self.fired.pop(key, None)
+            if prev and a.snmptype == self.args.name:
+                delta = a.date - prev.date
+                if not self.args.least or check_time_args(self.args, delta.seconds):
+                    self.resolved.append((key, prev, a, delta))
+
+    def report(self, full=False):
+        # counters and the newly resolved alerts; with full (SIGUSR1, exit)
+        # every open alert as well
+        now = time.time()
+        rate = (self.traps - self.report_traps) / max(now - self.report_time, 0.001)
+        open_counts = {}
+        for snmptype, name in self.fired:
+            open_counts[snmptype] = open_counts.get(snmptype, 0) + 1
+        opened = " ".join(f"{t}={n}" for t, n in sorted(open_counts.items())) or "none"
+        print(f"== {DT.datetime.now().replace(microsecond=0)} | {rate:.2f} traps/sec | {self.traps} traps | open: {opened}")
+        for (snmptype, name), prev, alert, delta in self.resolved:
+            print(f"    {name:<35} Duration: {delta.total_seconds():10} sec  {prev} {alert}")
+        self.resolved = []
+        if full:
+            utcnow = DT.datetime.now(DT.timezone.utc)
+            for (snmptype, name), (first, cnt) in sorted(self.fired.items()):
+                s = "alerts" if cnt > 1 else "alert"
+                print(f"    OPEN {snmptype} {name:<35} Fired: {first.date} | Open: {int((utcnow - first.date).total_seconds())} sec [{cnt} {s}]")
+        sys.stdout.flush()
+        self.report_time, self.report_traps = now, self.traps
+
+class trapTail:
+    # One trap file being followed, like tail -F: a new inode means it was
+    # rotated (the old file is read to the end first), a size below where we
+    # are means it was truncated.
+    def __init__(self, fn, live):
+        self.fn, self.live = fn, live
+        self.fd, self.inode, self.buf = None, None, b""
+
+    def open(self):
+        try:
+            self.fd = open(self.fn, "rb")
+        except FileNotFoundError:
+            return False
+        self.inode = os.fstat(self.fd.fileno()).st_ino
+        self.buf = b""
+        return True
+
+    def read(self):
+        # reads what's there, up to TAIL_CHUNK; False at the end of the file
+        data = self.fd.read(TAIL_CHUNK)
+        if not data:
+            return False
+        lines = (self.buf + data).split(b"\n")
+        self.buf = lines.pop()
+        for line in lines:
+            self.live.feed(line.decode("utf-8", "replace"))
+        return True
+
+    def check(self):
+        # at the end of the file: has it been rotated or truncated?
+        try:
+            st = os.stat(self.fn)
+        except FileNotFoundError:
+            return              # rotated away, not recreated yet
+        if st.st_ino != self.inode:
+            self.fd.close()
+            self.open()
+        elif st.st_size < self.fd.tell():
+            self.fd.seek(0)
+            self.buf = b""
+
+    async def follow(self, poll):
+        while self.fd is None and not self.open():
+            await asyncio.sleep(poll)
+        while True:
+            if self.read():
+                await asyncio.sleep(0)      # let the others have a go
+                continue
+            self.check()
+            await asyncio.sleep(poll)
+
+async def reporter(live, interval):
+    while True:
+        await asyncio.sleep(interval)
+        live.report()
+
+async def follow_traps(args):
+    # -f: reads what's in the files already, to know what's open now, then
+    # follows them, reporting every --interval seconds and on SIGUSR1
+    live = liveState(args)
+    tails = [trapTail(fn, live) for fn in args.trapfiles]
+    for t in tails:
+        if t.open():
+            while t.read():
+                pass
+    # what was already in the files isn't part of the traps/sec
+    live.resolved = []
+    live.report_time, live.report_traps = time.time(), live.traps
+    live.report(full=True)
+
+    loop = asyncio.get_running_loop()
+    done = asyncio.Event()
+    loop.add_signal_handler(signal.SIGUSR1, live.report, True)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, done.set)
+    tasks = [asyncio.ensure_future(t.follow(args.poll)) for t in tails]
+    tasks.append(asyncio.ensure_future(reporter(live, args.interval)))
+    await done.wait()
+    for task in tasks:
+        task.cancel()
+    live.report(full=True)
+
+class promFetcher:
+    # -p: the query_range calls alert-curl.sh would make, made here instead,
+    # over at most --fetch-jobs connections kept open (one per worker thread).
+    # Every response is cached under --cache, so a rerun asks for nothing it
+    # already has.
+    def __init__(self, args):
+        url = urllib.parse.urlsplit(args.prometheus)
+        self.https = url.scheme == "https"
+        self.netloc = url.netloc
+        self.path = url.path.rstrip("/") + "/api/v1/query_range"
+        self.step = args.step
+        self.cache = args.cache
+        self.jobs = args.fetch_jobs
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.queries, self.cached = 0, 0
+        os.makedirs(self.cache, exist_ok=True)
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = self.local.conn = conn_class(self.netloc, timeout=60)
+        return conn
+
+    def query_range(self, query, start, end):
+        params = urllib.parse.urlencode({"query": query, "start": start, "end": end, "step": self.step})
+        key = hashlib.sha1(f"{self.netloc}{self.path}?{params}".encode()).hexdigest()
+        cache_fn = os.path.join(self.cache, key + ".json")
+        try:
+            with open(cache_fn) as fd:
+                data = json.load(fd)
+            with self.lock:
+                self.cached += 1
+            return data
+        except (OSError, ValueError):
+            pass
+
+        with self.lock:
+            self.queries += 1
+        for attempt in (1, 2):
+            conn = self.connection()
+            try:
+                conn.request("GET", f"{self.path}?{params}")
+                resp = conn.getresponse()
+                body = resp.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # the server may have closed a connection we kept open
+                conn.close()
+                self.local.conn = None
+                if attempt == 2:
+                    raise
+        if resp.status != 200:
+            raise OSError(f"HTTP {resp.status} {resp.reason}: {body[:200].decode('utf-8', 'replace')}")
+        data = json.loads(body)
+        tmp = f"{cache_fn}.{threading.get_ident()}"
+        with open(tmp, "w") as fd:
+            json.dump(data, fd)
+        os.replace(tmp, cache_fn)
+        return data
+
+    def fetch(self, windows):
+        # {(peer, start, end): response, or the exception} for each window
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = { pool.submit(self.query_range, PROM_QUERY.format(peer=peer), start, end): (peer, start, end)
+                for peer, start, end in windows }
+            for f in concurrent.futures.as_completed(futures):
+                try:
+                    results[futures[f]] = f.result()
+                except Exception as e:
+                    results[futures[f]] = e
+        return results
+
+def coalesce_windows(windows, limit):
+    # the fewest (start, end) covering all the windows given, none of them
+    # more than limit seconds long
+    merged = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    chunks = []
+    for start, end in merged:
+        while end - start > limit:
+            chunks.append((start, start + limit))
+            start += limit
+        chunks.append((start, end))
+    return chunks
+
+def fetch_prometheus(args, alert_map):
+    # Gets the peer_connection_status history around every resolved alert
+    # into --report, laid out like the alert-curl.sh output. A peer's alert
+    # windows are merged where they overlap, so a flapping peer costs a few
+    # queries rather than one a flap, and each alert's slice is cut back out.
+    resolved = list(alert_map.resolved_alerts(args))
+    windows = {}
+    for k, prev, alert, delta in resolved:
+        windows.setdefault(k, []).append((int(prev.date.timestamp()) - PROM_MARGIN,
+            int(alert.date.timestamp()) + PROM_MARGIN))
+    chunks = [(k, start, end) for k, w in windows.items()
+        for start, end in coalesce_windows(w, args.step * (PROM_MAX_POINTS - 1))]
+
+    fetcher = promFetcher(args)
+    results = fetcher.fetch(chunks)
+    by_peer = {}
+    for (k, start, end), data in sorted(results.items(), key=lambda r: r[0][1]):
+        by_peer.setdefault(k, []).append((start, end, data))
+
+    errors = 0
+    with open(args.report, "w") as fd:
+        for k, pairs in itertools.groupby(resolved, key=lambda r: r[0]):
+            fd.write(f"Component Name: {k}\n\n")
+            for k, prev, alert, delta in pairs:
+                start = int(prev.date.timestamp()) - PROM_MARGIN
+                end = int(alert.date.timestamp()) + PROM_MARGIN
+                fd.write(f"{alert.date}: {delta.seconds:5} sec  {prev} {alert}\n")
+                series, error = {}, None
+                for c_start, c_end, data in by_peer[k]:
+                    if c_end < start or c_start > end:
+                        continue
+                    if isinstance(data, Exception):
+                        error = data
+                        break
+                    for r in data["data"]["result"]:
+                        values = [v for v in r["values"] if start <= v[0] <= end]
+                        key = json.dumps(r["metric"], sort_keys=True)
+                        s = series.setdefault(key, {"metric": r["metric"], "values": []})
+                        # split chunks share their boundary sample
+                        if s["values"] and values and s["values"][-1][0] == values[0][0]:
+                            values = values[1:]
+                        s["values"].extend(values)
+                if error:
+                    errors += 1
+                    fd.write(f"ERROR: {error}\n\n")
+                    continue
+                result = {"status": "success", "data": {"resultType": "matrix", "result": list(series.values())}}
+                fd.write(json.dumps(result, indent=4) + "\n\n")
+
+    print(f"Prometheus data for {len(resolved)} resolved alerts is in {args.report} "
+        f"({fetcher.queries} queries, {fetcher.cached} cached, {errors} failed)")
+
 def main(args):
-    all_alerts = read_alerts(args)
-    list_alerts_present(args, all_alerts)
+    if args.follow:
+        if [fn for fn in args.trapfiles if fn.endswith(".gz")]:
+            print("-f can't follow compressed files")
+            sys.exit(1)
+        asyncio.run(follow_traps(args))
+        sys.exit(0)
+
+    if args.raw or args.list:
+        args.state = None
+    state = load_state(args) if args.state else None
+
+    notifications, all_alerts, files, compressed = read_alerts(args, state)
+    if state:
+        for name, n in state["notifications"].items():
+            notifications[name] = notifications.get(name, 0) + n
+    list_alerts_present(args, notifications)
 
     if args.raw:
         all_alerts = sorted(all_alerts, key=lambda x: x.date)
@@ -282,13 +893,22 @@ def main(args):
     if args.list:
         sys.exit(0)
 
-    alert_map = mk_alert_map(args, all_alerts)
+    alert_map = mk_alert_map(args, all_alerts, carried_alerts(state) if state else ())
+    if state:
+        alert_map.count += state["count"]
     if args.script:
         alert_map.script_fd = initial_script(args)
 
     print(f"== Report for {args.name} ({alert_map.count} snmp traps present) ==")
-    print("  Resolved alerts:")
-    rcnt = alert_map.show_resolved_alerts(args)
+    print("  Resolved alerts:" if not state else "  Resolved alerts (since the last run):")
+    if args.aggregate:
+        rcnt = alert_map.aggregate_resolved_alerts(args)
+    else:
+        rcnt = alert_map.show_resolved_alerts(args)
+    if state:
+        rcnt += state["resolved"]
+    if args.state:
+        save_state(args, state, alert_map, notifications, files, compressed, rcnt)
     print("------------------")
     print("  Unresolved alerts:")
     print("--------------------")
@@ -297,19 +917,17 @@ def main(args):
     print(f"  Total traps present: {alert_map.count}")
     print(f"  Resolved total: {rcnt} [{rcnt*2} traps]")
     print(f"  Unresolved total: {ucnt} traps")
-    
-    sys.exit(0)
-
-    count = 0
-    #print(peers_map)
 
     if args.script:
-        script_fd.close()
+        alert_map.script_fd.close()
         os.chmod("alert-curl.sh", os.stat("alert-curl.sh").st_mode | stat.S_IXUSR | stat.S_IXOTH)
         print("curl command for customer is in alert-curl.sh")
-    else:
-        print("TOTAL matching criteria", count)
-    
+
+    if args.prometheus:
+        fetch_prometheus(args, alert_map)
+
+    sys.exit(0)
+
  
 
 
@@ -317,16 +935,30 @@ if __name__ == "__main__":
     ap = argparse.ArgumentParser(description="Analyze snmp trap alerts")
 #   logic changed to least and max.
 #     ap.add_argument("-t", "--time", default=deftime, type=float, help=f"time delta (float) in seconds between alert and clear (default={deftime:.1f})")
+    ap.add_argument("-a", "--aggregate", type=float, metavar="SECS", help="Summarize resolved alerts per component in SECS wide time buckets (outages, min/median/p99 duration, downtime) instead of listing each")
+    ap.add_argument("--flap-rate", default=10, type=float, help="with --aggregate, flag components with more outages an hour than this in a bucket (default: 10)")
+    ap.add_argument("-f", "--follow", action="store_true", help="Follow the trap files (handling rotation), keeping alert state in memory. Reports traps/sec, open alerts per type and alerts resolved every --interval seconds, and every open alert at start, on SIGUSR1 and at exit")
     ap.add_argument("-i", "--ignore", nargs="*", help="ignore regexp (includes default ^sigm)")
+    ap.add_argument("--interval", default=60, type=float, help="seconds between reports with -f (default: 60)")
+    ap.add_argument("--poll", default=1, type=float, help="seconds between checks for new traps with -f (default: 1)")
+    ap.add_argument("-j", "--jobs", type=int, default=1, help="parse the trap files with this many processes, 0 for one per cpu (default: 1)")
     ap.add_argument("--list", action="store_true", help="List all alert names present in traps and immediately exit")
     ap.add_argument("-l", "--least", default=0.0, type=float, help="least time to recovery)")
     ap.add_argument("-m", "--max", default=0, type=float, help="max time to recovery (optional. It not present, no max)")
     ap.add_argument("-n", "--name", type=str, default="DIAMETER_PEER_DOWN", help="Alert name (default: DIAMETER_PEER_DOWN)")
     ap.add_argument("-o", "--outside", action="store_true", help="Use OUTSIDE the values")
     ap.add_argument("-r", "--raw", action="store_true", help="Raw list of alerts and immediately exit")
+    ap.add_argument("-p", "--prometheus", metavar="URL", help="Fetch the hi-res data for the resolved alerts from this Prometheus (eg. http://localhost:9090) into --report, rather than scripting it with -s")
+    ap.add_argument("--report", default="prometheus-report.txt", help="with -p, file to write the data to (default: prometheus-report.txt)")
+    ap.add_argument("--cache", default="prometheus-cache", help="with -p, directory to cache responses in (default: prometheus-cache)")
+    ap.add_argument("--fetch-jobs", default=4, type=int, help="with -p, queries to run at once (default: 4)")
+    ap.add_argument("--step", default=1, type=int, help="with -p, query_range step in seconds (default: 1)")
     ap.add_argument("-s", "--script", action="store_true", help="Generate bash script to check hi-res data")
+    ap.add_argument("--state", help="state file for incremental runs (eg. from cron): only traps added since the last run are read, resolved alerts are those resolved since then, and totals and unresolved alerts cover everything seen. Not used with --list or --raw")
     ap.add_argument("-u", "--unresolved", action="store_true", help="Unresolved alerts (without a clear)")
     ap.add_argument("-v", "--verbose", action="store_true", help="Debugging info")
     ap.add_argument("trapfiles", nargs="+", help="trap files")
     args = ap.parse_args()
+    if args.jobs < 1:
+        args.jobs = os.cpu_count()
     main(args)
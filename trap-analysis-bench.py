@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# Micro-benchmark for the trap line parser in trap-analysis.py. Builds a
+# synthetic corpus of PCRF trap lines and times parse_alarm() over it, in
+# lines/sec, for each --script given, so an older copy of trap-analysis.py
+# can be timed against the current one. Works with python2 and python3.
+
+# Not official Cisco software.
+
+import argparse
+import os
+import random
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def make_lines(count, seed=1):
+    # Mostly component up/down alarms, some events, the odd message with a
+    # quoted ] or , in it; the shape snmptrapd logs them in
+    rnd = random.Random(seed)
+    hosts = ["lb01", "lb02", "pcrfclient01"] + ["qns%02d" % i for i in range(1, 11)]
+    lines = []
+    t = 1464739200
+    for i in range(count):
+        t += rnd.randint(0, 3)
+        ts = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)) + ".%03d+00:00" % rnd.randint(0, 999)
+        if rnd.random() < 0.2:
+            values = 'sub_id=%d, event_host=%s, msg="Event [%d] raised"' % (rnd.randint(1, 9),
+                rnd.choice(hosts), i)
+        else:
+            values = 'sub_id=%d, event_host=%s, status=%s, msg="Component %d is %s"' % (
+                rnd.randint(1, 9), rnd.choice(hosts), rnd.choice(["up", "down"]), i,
+                rnd.choice(["unreachable", "degraded", "back up"]))
+        lines.append('%s pcrfclient01 snmptrapd[1234]: TRAP, SNMP v1, community broadhop '
+            '.1.3.6.1.4.1.26878.200.3.2.70 Enterprise Specific Trap (%d) Uptime: 12 days '
+            '.1.3.6.1.4.1.26878.200.3.3.70.1 = STRING: "[id=%d,values={%s}]"' % (ts,
+            rnd.randint(1, 9), rnd.choice([7401, 7402, 7403, 7405]), values))
+    return lines
+
+def load(path, name):
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name, path)
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+    except ImportError:
+        import imp
+        mod = imp.load_source(name, path)
+    return mod
+
+def main(args):
+    lines = make_lines(args.lines)
+    print("%d synthetic trap lines\n" % len(lines))
+    print("%10s  %10s  %s" % ("seconds", "lines/s", "script"))
+    for n, script in enumerate(args.script or [os.path.join(HERE, "trap-analysis.py")]):
+        parse_alarm = load(script, "trap_analysis_%d" % n).parse_alarm
+        best = None
+        for i in range(args.repeat):
+            t0 = time.time()
+            for line in lines:
+                parse_alarm(line)
+            secs = time.time() - t0
+            best = secs if best is None or secs < best else best
+        print("%10.2f  %10d  %s" % (best, len(lines) / best, script))
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="benchmark the trap-analysis.py parser")
+    ap.add_argument("-n", "--lines", type=int, default=200000, help="trap lines to parse (default: 200000)")
+    ap.add_argument("-r", "--repeat", type=int, default=3, help="runs per script, best is kept (default: 3)")
+    ap.add_argument("--script", action="append",
+        help="trap-analysis.py to time, can be repeated (default: the one next to this)")
+    args = ap.parse_args()
+    main(args)
@@ -8,17 +8,25 @@ import argparse
 from datetime import datetime as DT
 import glob
 import gzip
+import heapq
+import multiprocessing
 import os
 import platform
 import re
 import sys
 import subprocess
 
-def parse_details(det):
-    int_re = re.compile("^\d+$")
+int_re = re.compile(r"^\d+$")
+id_re = re.compile(r"id=[0-9]{4},values=\{")
+# a well formed "[id=NNNN,values={...}]", where a ] only closes it outside quotes
+details_re = re.compile(r'\[id=([0-9]{4}),values=\{([^"\]]*(?:"[^"]*"[^"\]]*)*)\}\]')
+time_re = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}$")
+# what the analysis uses of an alarm, in the order -j workers send them back
+ALARM_FIELDS = ("time", "id", "sub_id", "event_host", "status", "msg")
 
+def parse_details(det):
     # I wish we had the parse library!
-    if not re.search("id=[0-9]{4},values=\{", det):
+    if not id_re.search(det):
         print("Alarm details fail expected ID pattern:")
         print(det)
         print("---")
@@ -28,6 +36,9 @@ def parse_details(det):
 
     values=det[det.index("{")+1:det.rfind("}", 0)]
 
+    return parse_values(id, values)
+
+def parse_values(id, values):
     tokens = { 
         "id" : id 
     }
@@ -43,101 +54,167 @@ def parse_details(det):
 
     return tokens
 
+def parse_time(dt_str):
+    # strptime is slow, and the traps all have the same fixed format
+    if not time_re.match(dt_str):
+        return DT.strptime(dt_str, "%Y-%m-%dT%H:%M:%S")
+    return DT(int(dt_str[0:4]), int(dt_str[5:7]), int(dt_str[8:10]),
+        int(dt_str[11:13]), int(dt_str[14:16]), int(dt_str[17:19]))
+
 def parse_alarm(alrm):
-    dt_str = alrm.split()[0]
+    dt_str = alrm.split(None, 1)[0]
     if "." in dt_str:
         # ditch milliseconds + time zone. Not useful
         dt_str = dt_str[:dt_str.index(".")]
 
-    if "[id=" not in alrm:
+    start = alrm.find("[id=")
+    if start < 0:
         print("Warning: no id in alarm log:")
         print(alrm)
         print("---")
         return None
 
-    lstr = alrm[alrm.index("[id=")+1:]
-
-    qflag = False
-    for i, c in enumerate(lstr):
-        if c == '"':
-            qflag = not qflag
-        if qflag:
-            continue
-        if c == "]":
-            break;
-
-    alarm_details = lstr[:i]
-    try:
-        alert = parse_details(alarm_details)
-    except:
-        alert = None
+    m = details_re.match(alrm, start)
+    if m:
+        try:
+            alert = parse_values(int(m.group(1)), m.group(2))
+        except:
+            alert = None
+    else:
+        # not quite the usual shape, so walk it the long way
+        lstr = alrm[start+1:]
+
+        qflag = False
+        for i, c in enumerate(lstr):
+            if c == '"':
+                qflag = not qflag
+            if qflag:
+                continue
+            if c == "]":
+                break;
+
+        alarm_details = lstr[:i]
+        try:
+            alert = parse_details(alarm_details)
+        except:
+            alert = None
     if not alert:
         return None
 
-    dt = DT.strptime(dt_str, "%Y-%m-%dT%H:%M:%S")
-    alert["time"] = dt
+    alert["time"] = parse_time(dt_str)
     return alert
 
 def nice_time_diff(delta):
     return str(delta)
 
+def read_alarms(fn):
+    # the parsed alarms in one trap file (plain or gzipped), read a line at
+    # a time rather than the whole file at once
+    if fn.endswith(".gz"):
+        fd = gzip.open(fn, "rt")
+    else:
+        fd = open(fn)
+    for line in fd:
+        if "TRAP, SNMP v1" in line:
+            a = parse_alarm(line.rstrip("\n"))
+            if a:
+                yield a
+    fd.close()
+
+def parse_file(fn):
+    # -j worker: one file's alarms as tuples of ALARM_FIELDS, which are a lot
+    # cheaper to send back than the dicts
+    return [tuple(a.get(f) for f in ALARM_FIELDS) for a in read_alarms(fn)]
+
+def unpack_alarms(alarms):
+    # back to dicts, without the keys the trap didn't have
+    for t in alarms:
+        yield dict((f, v) for f, v in zip(ALARM_FIELDS, t) if v is not None)
+
+def merge_alarms(files, jobs=1):
+    # The alarms from all the files in time order. snmptrapd appends traps as
+    # they arrive, so each file is in order already and a heap merge of the
+    # per-file streams does it without holding them all in memory. Ties stay
+    # in file, then line order, the same as a stable sort of everything.
+    # With jobs > 1 the files are parsed across a process pool first.
+    def keyed(n, alarms):
+        for i, a in enumerate(alarms):
+            yield (a["time"], n, i), a
+
+    if jobs > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(files)))
+        parsed = pool.map(parse_file, files)
+        pool.close()
+        pool.join()
+        streams = [keyed(n, unpack_alarms(alarms)) for n, alarms in enumerate(parsed)]
+    else:
+        streams = [keyed(n, read_alarms(fn)) for n, fn in enumerate(files)]
+    for key, a in heapq.merge(*streams):
+        yield a
+
+def pair_alarms(alerts, keep_cleared=False):
+    # Pairs each down alarm with the first later "up" of the same
+    # (id, sub_id, event_host), in one pass over the time sorted alerts.
+    # Downs waiting for their clear are kept in pending by the order they
+    # were raised, and per key in open_alarms; an up clears every one of them.
+    # The pairs are only kept with keep_cleared (-c), otherwise a cleared down
+    # is dropped right away and memory holds only the alarms still open.
+    # Returns (count, cleared, uncleared): how many alerts there were and,
+    # with cleared being [(down, up), ...], the downs in the order they were
+    # raised.
+    count = 0
+    raised = 0
+    pending = {}
+    cleared = {}
+    open_alarms = {}
+    for a in alerts:
+        count += 1
+        if "status" not in a:
+            continue        # an event alarm, these never clear
+        key = (a["id"], a["sub_id"], a["event_host"])
+        if a["status"] == "up":
+            # nothing open means a clear from an alarm that is no longer in the logs
+            for n in open_alarms.pop(key, []):
+                down = pending.pop(n)
+                if keep_cleared:
+                    cleared[n] = (down, a)
+        else:
+            open_alarms.setdefault(key, []).append(raised)
+            pending[raised] = a
+            raised += 1
+
+    return count, [cleared[n] for n in sorted(cleared)], [pending[n] for n in sorted(pending)]
+
 def main(args):
-    filec = []
     if not os.path.isdir(args.directory):
         print("{0}: does not exist or is not a directory".format(args.directory))
         sys.exit(1)
-    for fn in glob.glob(args.directory + "/trap*"):
-        if fn.endswith(".gz"):
-            fd = gzip.open(fn)
-            filec.append(fd.read())
-            fd.close()
-        else:
-            fd = open(fn)
-            filec.append(fd.read())
-            fd.close()
-
-    alerts = []
-    for fc in filec:
-        for lno, line in enumerate(fc.split("\n")):
-            if "TRAP, SNMP v1" in line:
-                a = parse_alarm(line)
-                if a:
-                    alerts.append(a)
-    alerts = sorted(alerts, key=lambda s: s["time"])
+    alerts = merge_alarms(glob.glob(args.directory + "/trap*"), args.jobs)
 
     uncleared = []
-    print("{0} alarms parsed. Beginning analysis".format(len(alerts)))
-    for i, a in enumerate(alerts):
-        if args.events:
+    if args.events:
+        count, events = 0, []
+        for a in alerts:
+            count += 1
             if "status" in a:
                 continue        # this is an up/down alert
+            events.append(a)
+        print("{0} alarms parsed. Beginning analysis".format(count))
+        for a in events:
             print("{time} {host} {id}/{sub_id} {msg}".format(time=a["time"].strftime("%Y-%m-%dT%H:%M:%S"),
                 id=a["id"], sub_id=a["sub_id"], msg=a["msg"], host=a["event_host"]))
-            continue
-        if "status" not in a:
-            continue
-        id, sub_id, host, status = a["id"], a["sub_id"], a["event_host"], a["status"]
-        if status == "up":
-            # an alert clear from an alarm that is no longer in the logs
-            continue
-
-        flag = False
-        for b in alerts[i+1:]:
-            if "status" not in b:
-                continue
-            if [id, sub_id, host, "up"] == [b["id"], b["sub_id"], b["event_host"], b["status"]]:
-                flag = True
-                break
-        if flag == False:
-            uncleared.append(a)
-        elif args.cleared:
-            t1=a["time"]
-            t2=b["time"]
-            print("{t1} <-> {t2} duration={duration}: {host} {id}/{sub_id} {msg}".format(
-                t1=t1.strftime("%Y-%m-%dT%H:%M:%S"),
-                t2=t2.strftime("%Y-%m-%dT%H:%M:%S"),
-                duration=nice_time_diff(t2-t1), id=a["id"], sub_id=a["sub_id"], msg=a["msg"], 
-                host=a["event_host"]))
+    else:
+        count, cleared, uncleared = pair_alarms(alerts, args.cleared)
+        print("{0} alarms parsed. Beginning analysis".format(count))
+        if args.cleared:
+            for a, b in cleared:
+                t1=a["time"]
+                t2=b["time"]
+                print("{t1} <-> {t2} duration={duration}: {host} {id}/{sub_id} {msg}".format(
+                    t1=t1.strftime("%Y-%m-%dT%H:%M:%S"),
+                    t2=t2.strftime("%Y-%m-%dT%H:%M:%S"),
+                    duration=nice_time_diff(t2-t1), id=a["id"], sub_id=a["sub_id"], msg=a["msg"], 
+                    host=a["event_host"]))
 
     # TODO !!! rewrite this as a socket
     if args.listalarms:
@@ -166,5 +243,8 @@ if __name__ == "__main__":
     ap.add_argument("-e", "--events", action="store_true", help="Show event alarms (that never have a clear)")
     ap.add_argument("-c", "--cleared", action="store_true", help="Show only alerts that later cleared")
     ap.add_argument("-l", "--listalarms", action="store_true", help="diagnostics list alarms")
+    ap.add_argument("-j", "--jobs", type=int, default=1, help="parse the trap files with this many processes, 0 for one per cpu (default: 1)")
     args = ap.parse_args()
+    if args.jobs < 1:
+        args.jobs = multiprocessing.cpu_count()
     main(args)